@@ -0,0 +1,270 @@
+"""
+bench.py generates synthetic C headers and times each phase of cj on them
+
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os, sys, json, time, argparse, tempfile, platform, statistics, subprocess
+from collections import OrderedDict
+import cj
+
+# name -> generate_header arguments
+SCENARIOS = OrderedDict([
+    ('structs', dict(structs=400)),
+    ('macros', dict(macros=400)),
+    ('typedef-chains', dict(typedef_depth=40, pointer_depth=6, chains=20)),
+    ('callbacks', dict(callbacks=200, structs=20)),
+    ('enums', dict(enums=10, enum_size=500)),
+    ('mixed', dict(structs=100, macros=100, typedef_depth=10, pointer_depth=3, chains=10,
+                   callbacks=50, enums=5, enum_size=100, functions=200)),
+])
+
+
+def generate_header(structs=0, macros=0, typedef_depth=0, pointer_depth=0, chains=0,
+                    callbacks=0, enums=0, enum_size=0, functions=0):
+    """
+    Generate the source of a header with `structs` structs referring to each
+    other, `macros` macros (mostly constants, some expressions over other
+    macros, some that aren't constants at all), `chains` typedef chains
+    `typedef_depth` deep ending in a `pointer_depth` deep pointer,
+    `callbacks` function pointer typedefs gathered into callback tables,
+    `enums` enums of `enum_size` values each and `functions` functions.
+    """
+    # cj only looks for macros in headers that declare something
+    lines = ['#ifndef BENCH_H', '#define BENCH_H', '#include <stddef.h>', '#include <stdint.h>', '',
+             'int bench_version(void);', '']
+    field_types = ['int', 'unsigned int', 'char *', 'double', 'uint64_t', 'size_t', 'const char *', 'float[4]']
+    for i in range(structs):
+        fields = []
+        for j in range(i % 6 + 2):
+            t = field_types[(i + j) % len(field_types)]
+            if t.endswith(']'):
+                base, _, dims = t.partition('[')
+                fields.append(f'{base} f{j}[{dims};')
+            else:
+                fields.append(f'{t} f{j};')
+        if i:
+            fields.append(f'struct s{i - 1} *prev;')
+            fields.append(f'struct s{i // 2} inner;')
+        if i % 5 == 0:
+            fields.append('union { int as_int; float as_float; } u;')
+        lines.append(f'typedef struct s{i} {{ {" ".join(fields)} }} s{i}_t;')
+    lines.append('')
+
+    for i in range(macros):
+        kind = i % 8
+        if kind == 0:
+            body = str(i)
+        elif kind == 1:
+            body = f'0x{i:x}u'
+        elif kind == 2:
+            body = f'({i}.5f * 2)'
+        elif kind == 3:
+            body = f'"macro {i}"'
+        elif kind == 4 and i >= 8:
+            body = f'(M{i - 4} + M{i - 8} * 2)'
+        elif kind == 5:
+            body = f'(1ull << {i % 64})'
+        elif kind == 6:
+            body = f'((int){i})'
+        else:
+            lines.append(f'#define F{i}(x) ((x) + {i})')
+            body = f'F{i}'
+        lines.append(f'#define M{i} {body}')
+    lines.append('')
+
+    for c in range(chains):
+        lines.append(f'typedef int{"*" * pointer_depth} chain{c}_0;')
+        for d in range(1, typedef_depth):
+            lines.append(f'typedef chain{c}_{d - 1} chain{c}_{d};')
+        if typedef_depth:
+            lines.append(f'typedef chain{c}_{typedef_depth - 1} *chain{c}_ptr;')
+    lines.append('')
+
+    for i in range(callbacks):
+        args = ['void *user_data', 'int n']
+        if structs:
+            args.insert(0, f'struct s{i % structs} *s')
+        if i % 3 == 0:
+            args.append(f'cb{i - 1}_fn next' if i else 'void (*done)(int)')
+        lines.append(f'typedef int (*cb{i}_fn)({", ".join(args)});')
+    for i in range(0, callbacks, 10):
+        members = ' '.join(f'cb{j}_fn on{j};' for j in range(i, min(i + 10, callbacks)))
+        lines.append(f'struct callbacks{i // 10} {{ {members} void (*reserved[4])(void); }};')
+        lines.append(f'int register_callbacks{i // 10}(const struct callbacks{i // 10} *table, void *user_data);')
+    lines.append('')
+
+    for e in range(enums):
+        values = ', '.join(f'E{e}_V{v} = {v * 3}' if v % 7 == 0 else f'E{e}_V{v}' for v in range(enum_size))
+        lines.append(f'typedef enum e{e} {{ {values} }} e{e}_t;')
+    lines.append('')
+
+    for i in range(functions):
+        ret = f's{i % structs}_t *' if structs else 'int '
+        lines.append(f'{ret}fn{i}(int a, const char *b, double c{", ..." if i % 4 == 0 else ""});')
+    lines.append('')
+    lines.append('#endif')
+    return '\n'.join(lines) + '\n'
+
+
+def run_once(header, visitor_kwargs):
+    """
+    Extract `header` once, timing it with the same `Timings` hooks as
+    `cj.py --timings`, plus the JSON encoding of the result.
+    """
+    timings = cj.Timings()
+    start = time.perf_counter()
+    with cj.Visitor(header, hooks=timings, **visitor_kwargs) as visitor:
+        definitions = visitor.all_definitions()
+        with timings.phase(visitor, 'json'):
+            json.dumps(definitions)
+    total = time.perf_counter() - start
+    phases = { name: phase['time'] for name, phase in timings.phases.items() }
+    # nested phases (`outer.inner`) are already part of their outer phase
+    phases['other'] = max(total - sum(t for name, t in phases.items() if '.' not in name), 0.0)
+    return {
+        'total': total,
+        'phases': phases,
+        'calls': { name: phase['calls'] for name, phase in timings.phases.items() if name != 'json' },
+        'counters': dict(timings.counters),
+        'definitions': len(definitions),
+    }
+
+
+def run_scenario(name, params, args, visitor_kwargs):
+    with tempfile.TemporaryDirectory(prefix='cj-bench-') as tmp:
+        header = os.path.join(tmp, f'{name}.h')
+        with open(header, 'w') as f:
+            f.write(generate_header(**params))
+        if args.warmup:
+            run_once(header, visitor_kwargs)
+        runs = [run_once(header, visitor_kwargs) for _ in range(args.repeat)]
+    return {
+        'name': name,
+        'params': params,
+        'definitions': runs[0]['definitions'],
+        'calls': runs[0]['calls'],
+        'counters': runs[0]['counters'],
+        # medians are less sensitive to the odd slow run than means
+        'total': statistics.median(r['total'] for r in runs),
+        'phases': { p: statistics.median(r['phases'].get(p, 0.0) for r in runs)
+                    for p in OrderedDict((p, None) for r in runs for p in r['phases']) },
+        'runs': [r['total'] for r in runs],
+    }
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def compare(results, baseline):
+    """
+    Print how each scenario and phase changed relative to an earlier run.
+    """
+    previous = { s['name']: s for s in baseline['scenarios'] }
+    print(f"compared to {baseline.get('revision') or 'baseline'}:", file=sys.stderr)
+    for scenario in results['scenarios']:
+        before = previous.get(scenario['name'])
+        if not before:
+            continue
+        def ratio(new, old):
+            return f'{new / old:.2f}x' if old > 0.0005 else '-'
+        phases = ' '.join(f"{p}={ratio(t, before['phases'].get(p, 0))}" for p, t in scenario['phases'].items())
+        note = '' if before['params'] == scenario['params'] else ', generated with different parameters'
+        print(f"  {scenario['name']}: {ratio(scenario['total'], before['total'])} ({phases}){note}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark cj on synthetic headers, timing each phase")
+    parser.add_argument("scenarios", metavar="SCENARIO", nargs="*",
+                        help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-s", "--scale", metavar="FACTOR", type=float, default=1.0,
+                        help="Scale the size of every scenario by FACTOR (default: 1)")
+    parser.add_argument("-r", "--repeat", metavar="N", type=int, default=3,
+                        help="Run each scenario N times and report the median (default: 3)")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false",
+                        help="Don't do an untimed run of each scenario first")
+    parser.add_argument("-c", "--clang", metavar="PATH", type=str,
+                        help="Specify the path to `clang`")
+    parser.add_argument("-a", "--xargs", metavar="ARGS", type=str, nargs="+",
+                        help="Pass arguments through to clang")
+    parser.add_argument("-e", "--engine", choices=["clang", "libclang"], default="clang",
+                        help="Engine to benchmark (default: clang)")
+    parser.add_argument("-b", "--batch-defines", metavar="SIZE", type=int, nargs="?", const=256, default=0,
+                        help="Probe macros in batches of SIZE (default: 256)")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="Run up to N clang macro probes concurrently (default: 1)")
+    parser.add_argument("-o", "--output", metavar="PATH", type=str,
+                        help="Write the results as JSON to PATH (default: stdout)")
+    parser.add_argument("--compare", metavar="PATH", type=str,
+                        help="Compare against the results of an earlier run saved with `--output`")
+    parser.add_argument("--dump", metavar="DIR", type=str,
+                        help="Only write the generated headers to DIR, without benchmarking")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario `{unknown[0]}`")
+
+    scenarios = OrderedDict((name, { k: max(1, round(v * args.scale)) if k not in ('typedef_depth', 'pointer_depth') else v
+                                     for k, v in SCENARIOS[name].items() })
+                            for name in (args.scenarios or SCENARIOS))
+    if args.dump:
+        os.makedirs(args.dump, exist_ok=True)
+        for name, params in scenarios.items():
+            with open(os.path.join(args.dump, f'{name}.h'), 'w') as f:
+                f.write(generate_header(**params))
+        sys.exit(0)
+
+    visitor_kwargs = dict(
+        clang_path=args.clang,
+        clang_args=[x.strip() for x in args.xargs] if args.xargs else [],
+        engine=args.engine,
+        macro_batch_size=args.batch_defines,
+        jobs=args.jobs)
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'libclang': cj.libclang_version(),
+        'engine': args.engine,
+        'options': { k: v for k, v in visitor_kwargs.items() if k != 'engine' },
+        'repeat': args.repeat,
+        'scenarios': [],
+    }
+    for name, params in scenarios.items():
+        scenario = run_scenario(name, params, args, visitor_kwargs)
+        print(f"{name}: {scenario['total']:.3f}s, {scenario['definitions']} definitions", file=sys.stderr)
+        results['scenarios'].append(scenario)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
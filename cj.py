@@ -26,7 +26,9 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import re, sys, os, subprocess, signal, tempfile, argparse, json
+import re, sys, os, shutil, subprocess, signal, tempfile, argparse, json, hashlib, time, itertools, math, operator
+import contextlib, functools, threading, cProfile, io, socket, socketserver, traceback, sqlite3
+import concurrent.futures
 from collections import OrderedDict
 from pathlib import Path, PurePath
 import clang.cindex as clang
@@ -35,7 +37,28 @@ ANONYMOUS_SUB_RE = re.compile(r'(.*/|\W)')
 UNION_STRUCT_NAME_RE = re.compile(r'(union|struct)\s+(.+)')
 ENUM_NAME_RE = re.compile(r'enum\s+(.+)')
 MATCH_ALL_RE = re.compile('.*')
-DEFINE_RE = re.compile(r'#[ \t]*define[ \t]+([a-zA-Z_][a-zA-Z0-9_]*)[ \t]+')
+DEFAULT_RE_FLAGS = re.compile('').flags
+UNDEF_RE = re.compile(rb'^[ \t]*#[ \t]*undef[ \t]+([a-zA-Z_][a-zA-Z0-9_]*)', re.M)
+PROBE_ERROR_RE = re.compile(rb'^<stdin>:(\d+):\d+: (?:fatal )?error:', re.M)
+CLANG_VERSION_RE = re.compile(r'clang version (\d+(?:\.\d+)*)')
+PROBE_FILENAME = '__cj_probe__.c'
+# `clang --version` output by path, for cache keys
+CLANG_VERSIONS = {}
+# environment variables clang takes include paths from
+CLANG_ENV = ('CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH', 'OBJC_INCLUDE_PATH', 'SDKROOT')
+# environment variables `cj-client` forwards, as they change what clang finds
+SERVER_ENV = ('PATH',) + CLANG_ENV
+TYPE_DEFINITION_KINDS = ('struct', 'union', 'enum', 'typedef')
+DIAGNOSTIC_SEVERITIES = { 0: 'ignored', 1: 'note', 2: 'warning', 3: 'error', 4: 'fatal error' }
+INTEGER_LITERAL_RE = re.compile(r'(?:0[xX]([0-9a-fA-F]+)|0[bB]([01]+)|(0[0-7]*)|([1-9][0-9]*))([uU]?(?:ll|LL|[lL])?|(?:ll|LL|[lL])[uU])')
+FLOAT_LITERAL_RE = re.compile(r'((?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+)([fFlL]?)')
+CHAR_LITERAL_RE = re.compile(r"'(?:([^'\\\n])|\\([ntvbrfa\\'\"?])|\\([0-7]{1,3})|\\x([0-9a-fA-F]+))'")
+STRING_LITERAL_RE = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+TYPE_LITERALS = OrderedDict([
+    ('int', '0'), ('unsigned int', '0u'), ('long', '0l'), ('unsigned long', '0ul'),
+    ('long long', '0ll'), ('unsigned long long', '0ull'),
+    ('float', '0.f'), ('double', '0.'), ('long double', '0.l'), ('string', '""'),
+])
 BUILTIN_C_INTS = { "int8_t", "int16_t", "int32_t", "int64_t", "intptr_t", "ssize_t" }
 BUILTIN_C_UINTS = { "uint8_t", "uint16_t", "uint32_t", "uint64_t", "uintptr_t", "size_t" }
 BUILTIN_C_DEFINITIONS = {
@@ -56,11 +79,306 @@ class CompilationError(Exception):
     pass
 
 
+class ProbeTimeout(CompilationError):
+    """
+    A macro probe ran out of `probe_timeout`, retrying any part of it would too.
+    """
+
+
+class NotConstant(Exception):
+    pass
+
+
+def libclang_version():
+    get_version = clang.conf.lib.clang_getClangVersion
+    get_version.restype = clang._CXString
+    get_version.errcheck = clang._CXString.from_result
+    return get_version()
+
+
+def clang_version(clang_path):
+    """
+    The `clang --version` output of `clang_path`, or '' if it can't be run.
+    """
+    version = CLANG_VERSIONS.get(clang_path)
+    if version is None:
+        try:
+            version = subprocess.run([clang_path, '--version'], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL).stdout.decode('utf-8', 'replace')
+        except OSError:
+            version = ''
+        CLANG_VERSIONS[clang_path] = version
+    return version
+
+
+def format_diagnostics(diagnostics, source_path=None):
+    """
+    Format libclang diagnostics the way the clang driver prints them,
+    naming `source_path` `<stdin>` like a source piped to clang would be.
+    """
+    lines = []
+    for d in diagnostics:
+        f = d.location.file
+        filename = '<stdin>' if f and f.name == source_path else (f.name if f else '')
+        lines.append('{}:{}:{}: {}: {}'.format(filename, d.location.line, d.location.column,
+                                               DIAGNOSTIC_SEVERITIES.get(d.severity, 'error'), d.spelling))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of extracted definitions. Entries are keyed on everything
+    that affects a header's output and record the digest of every file the
+    translation unit included, so an entry is only a hit while none of them
+    changed. Entries can also carry a file, such as a precompiled header.
+    Least recently used entries are evicted once the cache grows past
+    `max_size` bytes. Keys also cover the source of cj itself and the
+    environment variables clang takes include paths from.
+    """
+    SOURCE_DIGEST = None
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    def key(self, *parts):
+        if ResultCache.SOURCE_DIGEST is None:
+            ResultCache.SOURCE_DIGEST = file_digest(__file__)
+        environment = { name: os.environ.get(name) for name in CLANG_ENV }
+        return hashlib.sha256(json.dumps([self.SOURCE_DIGEST, environment, *parts]).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return self.path / f"{key}.json"
+
+    def load(self, key):
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            if any(file_digest(dep) != digest for dep, digest in entry['dependencies'].items()):
+                return None
+            os.utime(entry_path)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry['result']
+
+    def store(self, key, dependencies, result):
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = {
+            'dependencies': { dep: file_digest(dep) for dep in dependencies },
+            'result': result,
+        }
+        with tempfile.NamedTemporaryFile('w', dir=self.path, suffix='.tmp', delete=False) as f:
+            json.dump(entry, f, separators=(',', ':'))
+        os.replace(f.name, self.entry_path(key))
+        self.evict()
+
+    def load_file(self, key, suffix):
+        """
+        The path of the file stored with `store_file`, while its dependencies
+        are unchanged.
+        """
+        file_path = self.path / f"{key}{suffix}"
+        if self.load(key) is None or not file_path.exists():
+            return None
+        os.utime(file_path)
+        return str(file_path)
+
+    def store_file(self, key, dependencies, source_path, suffix):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False) as f:
+            with open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, f)
+        os.replace(f.name, self.path / f"{key}{suffix}")
+        self.store(key, dependencies, { 'file': suffix })
+
+    def evict(self):
+        entries = {}
+        for entry_path in self.path.iterdir():
+            if entry_path.suffix == '.tmp':
+                continue
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            mtime, size, paths = entries.get(entry_path.stem, (0, 0, []))
+            entries[entry_path.stem] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry_path])
+        total = sum(size for _, size, _ in entries.values())
+        for _, size, paths in sorted(entries.values()):
+            if total <= self.max_size:
+                break
+            for entry_path in paths:
+                try:
+                    entry_path.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+
+class Hooks:
+    """
+    Instrumentation hooks for a `Visitor`. `phase` is entered around each
+    phase of the work, with nested phases named `outer.inner`, and `count`
+    is called with counters as they change. Both do nothing by default.
+    """
+    def phase(self, visitor, name):
+        return contextlib.nullcontext()
+
+    def count(self, visitor, name, n=1):
+        pass
+
+
+class Timings(Hooks):
+    """
+    Hooks totalling the wall time and calls of each phase and each counter,
+    across all the visitors they're given to.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, visitor, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, { 'time': 0.0, 'calls': 0 })
+                phase['time'] += elapsed
+                phase['calls'] += 1
+
+    def count(self, visitor, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return { 'phases': self.phases, 'counters': self.counters }
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def type_references(d, refs=None, types=None):
+    """
+    Collect the base type names a serialized definition refers to,
+    following `{"$ref": id}` references into `types` when given.
+    """
+    if refs is None:
+        refs = set()
+    if isinstance(d, dict):
+        if types is not None and '$ref' in d:
+            d = types[d['$ref']]
+        if d.get('base'):
+            refs.add(d['base'])
+        d = d.values()
+    if not isinstance(d, str):
+        for v in d:
+            if isinstance(v, (dict, list)):
+                type_references(v, refs, types)
+    return refs
+
+
+def reachable_declarations(roots, declarations, types=None):
+    """
+    Walk the types used by the serialized definitions `roots` — return types,
+    arguments, fields, pointed-to and element types, typedef targets — and
+    return the spellings of the `declarations` reached. These are pairs of a
+    spelling and a function serializing the declaration, so that only the
+    declarations reached have to be serialized to follow their fields. A
+    spelling can be shared, say by `typedef struct {...} name_t` and its
+    struct, and reaching it follows all of them.
+    """
+    serializers = {}
+    for spelling, serialize in declarations:
+        serializers.setdefault(spelling, []).append(serialize)
+    reached = set()
+    seen = set()
+    pending = list(roots)
+    while pending:
+        d = pending.pop()
+        if id(d) in seen:
+            continue
+        seen.add(id(d))
+        if isinstance(d, list):
+            pending.extend(v for v in d if isinstance(v, (dict, list)))
+            continue
+        if types is not None and '$ref' in d:
+            pending.append(types[d['$ref']])
+            continue
+        # pointers and arrays only name the type they're of in `base`
+        for spelling in (d.get('spelling'), d.get('base')):
+            if spelling not in reached and spelling in serializers:
+                reached.add(spelling)
+                pending.extend(serialize() for serialize in serializers[spelling])
+        pending.extend(v for v in d.values() if isinstance(v, (dict, list)))
+    return reached
+
+
+def declared_type(cursor):
+    if cursor.kind in (clang.CursorKind.TYPEDEF_DECL, clang.CursorKind.ENUM_DECL, clang.CursorKind.STRUCT_DECL, clang.CursorKind.UNION_DECL):
+        return cursor.type.spelling
+    return None
+
+
+def combine_patterns(patterns):
+    """
+    Compile regular expressions into as few as match wherever any of them
+    would, or `None` if there are none. Those with groups (which
+    backreferences need) or global inline flags like `(?i)` would change
+    meaning in an alternation, so they're kept on their own, the rest are
+    merged into one.
+    """
+    if not patterns:
+        return None
+    compiled = [re.compile(p) for p in patterns]
+    result = [p for p in compiled if p.groups or p.flags != DEFAULT_RE_FLAGS]
+    plain = [p.pattern for p in compiled if not (p.groups or p.flags != DEFAULT_RE_FLAGS)]
+    if plain:
+        result.insert(0, re.compile('|'.join(f'(?:{p})' for p in plain)))
+    return result
+
+def search_any(patterns, string):
+    return any(p.search(string) for p in patterns)
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f"cj-{os.getuid()}.sock")
+
+def load_libclang(libclang_path):
+    if os.path.exists(libclang_path):
+        try:
+            if os.path.isfile(libclang_path):
+                clang.Config.set_library_file(libclang_path)
+            else:
+                clang.Config.set_library_path(libclang_path)
+        except clang.LibclangError as e: # Failed to load library
+            print(f"ERROR: {str(e)}")
+        except: # Error occurs when library is already loaded, skip
+            pass
+    else:
+        print(f"ERROR! Path \"{libclang_path}\" doesn't exist")
+        sys.exit(1)
+
+
 class Definition:
+    __slots__ = ('kind',)
+
     def __init__(self, kind):
         self.kind = kind
 
-    def to_dict(self, is_declaration=True):
+    def to_dict(self, is_declaration=True, types=None):
         return {
             'kind': self.kind,
         }
@@ -69,25 +387,107 @@ class Definition:
         return self.kind in ('struct', 'union')
 
 
+class TypeRegistry:
+    """
+    The types processed from a translation unit, keyed by declaration hash,
+    or for types without a declaration of their own (pointers, arrays,
+    functions, builtins) by kind, spelling and canonical spelling. Each
+    `Visitor` owns its own registry, so types never leak between headers.
+
+    With `trace`, `registered` records the declarations in the order they
+    would be registered if every lookup started from an empty registry, so
+    the declarations a cursor brings in can be replayed in a later run.
+    """
+    def __init__(self, trace=False):
+        self.type_declarations = OrderedDict()
+        self.processed_types = {}
+        self.created = 0
+        self.hits = 0
+        self.trace = trace
+        self.registered = []
+        self.closures = {}
+
+    def register(self, declaration, the_type):
+        self.type_declarations[declaration.hash] = the_type
+        if self.trace:
+            self.registered.append(the_type)
+
+    def replay(self, the_type):
+        # a hit registers nothing, but would have registered what building it did
+        if self.trace:
+            self.registered.extend(self.closures.get(id(the_type), ()))
+
+    def built(self, the_type, start):
+        if self.trace:
+            self.closures[id(the_type)] = self.registered[start:]
+
+    def from_clang(self, t):
+        return Type.from_clang(t, self)
+
+    def lookup(self, t):
+        """
+        The `Type` for `t` and, if it wasn't processed yet, the generator
+        building it, which is `None` otherwise.
+        """
+        if t.kind == clang.TypeKind.AUTO:
+            # process actual type
+            t = t.get_canonical()
+        if t.kind == clang.TypeKind.ELABORATED:
+            # just process inner type
+            t = t.get_named_type()
+        declaration = t.get_declaration()
+        key = declaration.hash
+        the_type = self.processed_types.get(key)
+        if the_type is None and not Type.is_declared(t):
+            key = (t.kind.value, t.spelling, t.get_canonical().spelling)
+            the_type = self.processed_types.get(key)
+        if the_type is not None:
+            self.hits += 1
+            return the_type, None
+        self.created += 1
+        # registered before it's built, so types referring back to it find it
+        the_type = self.processed_types[key] = Type()
+        return the_type, the_type.build(t, declaration, self)
+
+    def release(self):
+        self.type_declarations.clear()
+        self.processed_types.clear()
+        self.registered = []
+        self.closures.clear()
+
+
 class Type(Definition):
-    type_declarations = OrderedDict()
-    processed_types = {}
+    """
+    A C type, copied out of libclang so that it holds no reference to the
+    translation unit once built. Attributes that don't apply to a kind of
+    type are left as `None`.
+    """
+    __slots__ = ('dicts', 'clang_kind', 'spelling', 'size', 'file', 'name',
+                 'anonymous', 'fields', 'opaque', 'type', 'values', 'array',
+                 'element_type', 'inner', 'function', 'return_type',
+                 'arguments', 'variadic', 'const', 'volatile', 'restrict',
+                 'base')
 
     class Field:
-        def __init__(self, field_cursor):
-            self.name = field_cursor.spelling
-            self.type = Type.from_clang(field_cursor.type)
+        __slots__ = ('name', 'type')
 
-        def to_dict(self):
+        def __init__(self, name, field_type):
+            self.name = name
+            self.type = field_type
+
+        def to_dict(self, types=None):
             return {
                 'name': self.name,
-                'type': self.type.to_dict(),
+                'type': self.type.reference(types),
             }
 
     class EnumValue:
-        def __init__(self, name, value):
+        __slots__ = ('name', 'value', 'int_typed')
+
+        def __init__(self, name, value, int_typed=True):
             self.name = name
             self.value = value
+            self.int_typed = int_typed
 
         def to_dict(self):
             return {
@@ -95,20 +495,31 @@ class Type(Definition):
                 'value': self.value,
             }
 
-    def __init__(self, t):
+    def __init__(self):
         super().__init__('')
-        self.clang_type = t
+        self.dicts = {}
+        self.file = self.name = self.fields = self.type = self.values = None
+        self.array = self.element_type = self.inner = self.function = None
+        self.return_type = self.arguments = None
+        self.anonymous = self.opaque = self.variadic = False
+
+    def build(self, t, declaration, registry):
+        """
+        Copy `t` out of libclang. This is a generator that yields each clang
+        type `t` is made of and is sent back its `Type`, so `from_clang` can
+        build a whole graph of types without recursing.
+        """
         self.clang_kind = t.kind
         self.spelling = t.spelling
         self.size = t.get_size()
-        declaration = t.get_declaration()
         base = t
+        if declaration.location.file:
+            self.file = declaration.location.file.name
         if t.spelling in BUILTIN_C_INTS:
             self.kind = 'int'
         elif t.spelling in BUILTIN_C_UINTS:
             self.kind = 'uint'
         elif t.kind == clang.TypeKind.RECORD and t.spelling not in BUILTIN_C_DEFINITIONS:
-            self.processed_types[declaration.hash] = self  # mark early to avoid recursion
             m = UNION_STRUCT_NAME_RE.match(t.spelling)
             if m:
                 union_or_struct = m.group(1)
@@ -123,11 +534,12 @@ class Type(Definition):
                 self.anonymous = False
                 self.name = t.spelling
             self.kind = union_or_struct
-            self.fields = [Type.Field(f) for f in t.get_fields()]
+            self.fields = []
+            for f in t.get_fields():
+                self.fields.append(Type.Field(f.spelling, (yield f.type)))
             self.opaque = not self.fields
-            self.type_declarations[declaration.hash] = self
+            registry.register(declaration, self)
         elif t.kind == clang.TypeKind.ENUM:
-            self.processed_types[declaration.hash] = self  # mark early to avoid recursion
             m = ENUM_NAME_RE.match(t.spelling)
             if m:
                 self.anonymous = bool(ANONYMOUS_SUB_RE.search(m.group(1)))
@@ -137,36 +549,41 @@ class Type(Definition):
                 self.anonymous = False
                 self.name = t.spelling
             self.kind = 'enum'
-            self.type = Type.from_clang(declaration.enum_type)
-            self.values = [Type.EnumValue(c.spelling, c.enum_value) for c in declaration.get_children()]
-            self.type_declarations[declaration.hash] = self
+            self.type = yield declaration.enum_type
+            self.values = [Type.EnumValue(c.spelling, c.enum_value, c.type.kind == clang.TypeKind.INT)
+                           for c in declaration.get_children()]
+            registry.register(declaration, self)
         elif t.kind == clang.TypeKind.TYPEDEF and t.spelling not in BUILTIN_C_DEFINITIONS:
-            self.processed_types[declaration.hash] = self  # mark early to avoid recursion
             self.kind = 'typedef'
             self.name = t.get_typedef_name()
-            self.type = Type.from_clang(declaration.underlying_typedef_type)
-            self.type_declarations[declaration.hash] = self
+            self.type = yield declaration.underlying_typedef_type
+            registry.register(declaration, self)
         elif t.kind == clang.TypeKind.POINTER:
             self.kind = 'pointer'
             self.array, base = self.process_pointer_or_array(t)
-            self.element_type = Type.from_clang(base)
+            self.element_type = yield base
+            self.inner = self.element_type if len(self.array) == 1 else (yield t.get_pointee())
             self.spelling = self.spelling.replace(base.spelling, self.element_type.spelling)
             if base.kind in (clang.TypeKind.FUNCTIONPROTO, clang.TypeKind.FUNCTIONNOPROTO):
                 self.function = self.element_type
         elif t.kind in (clang.TypeKind.CONSTANTARRAY, clang.TypeKind.INCOMPLETEARRAY):
             self.kind = 'array'
             self.array, base = self.process_pointer_or_array(t)
-            self.element_type = Type.from_clang(base)
+            self.element_type = yield base
+            self.inner = self.element_type if len(self.array) == 1 else (yield t.element_type)
             self.spelling = self.spelling.replace(base.spelling, self.element_type.spelling)
         elif t.kind == clang.TypeKind.VECTOR:
             self.kind = 'vector'
             self.array, base = self.process_pointer_or_array(t)
-            self.element_type = Type.from_clang(base)
+            self.element_type = yield base
+            self.inner = self.element_type if len(self.array) == 1 else (yield t.element_type)
             self.spelling = self.spelling.replace(base.spelling, self.element_type.spelling)
         elif t.kind in (clang.TypeKind.FUNCTIONPROTO, clang.TypeKind.FUNCTIONNOPROTO):
             self.kind = 'function'
-            self.return_type = Type.from_clang(t.get_result())
-            self.arguments = [Type.from_clang(a) for a in t.argument_types()]
+            self.return_type = yield t.get_result()
+            self.arguments = []
+            for a in t.argument_types():
+                self.arguments.append((yield a))
             self.variadic = t.kind == clang.TypeKind.FUNCTIONPROTO and t.is_function_variadic()
         elif t.kind == clang.TypeKind.VOID:
             self.kind = 'void'
@@ -188,6 +605,18 @@ class Type(Definition):
         self.restrict = base.is_restrict_qualified()
         self.base = base_type(base.spelling if base is not t else self.spelling)
 
+    @staticmethod
+    def is_declared(t):
+        """
+        Whether the `Type` for `t` is a declaration, registered by the hash of
+        its declaration cursor.
+        """
+        if t.spelling in BUILTIN_C_INTS or t.spelling in BUILTIN_C_UINTS:
+            return False
+        if t.kind in (clang.TypeKind.RECORD, clang.TypeKind.TYPEDEF):
+            return t.spelling not in BUILTIN_C_DEFINITIONS
+        return t.kind == clang.TypeKind.ENUM
+
     def root(self):
         t = self
         while t.kind == 'typedef':
@@ -211,56 +640,84 @@ class Type(Definition):
 
     def remove_pointer(self):
         if self.kind == 'pointer':
-            return Type.from_clang(self.clang_type.get_pointee())
+            return self.inner
         return self
 
     def is_array(self):
         return self.kind == 'array'
 
     def remove_array(self):
-        if self.kind == 'pointer':
-            return Type.from_clang(self.clang_type.get_pointee())
-        elif self.kind in ('array', 'vector'):
-            return Type.from_clang(self.clang_type.element_type)
+        if self.kind in ('pointer', 'array', 'vector'):
+            return self.inner
         return self
 
     def is_function_pointer(self):
-        return self.kind == 'pointer' and hasattr(self, 'function')
+        return self.kind == 'pointer' and self.function is not None
 
     def is_variadic(self):
-        return getattr(self, 'variadic', False)
+        return self.variadic
 
     def is_anonymous(self):
-        return getattr(self, 'anonymous', False)
+        return self.anonymous
+
+    def to_dict(self, is_declaration=False, types=None):
+        """
+        Serialize this type, memoized so shared types are only built once.
+        When given a `types` table, the types this one refers to are added to
+        it and referred to by `{"$ref": id}` instead of being nested.
+        """
+        key = (is_declaration, types is not None)
+        result = self.dicts.get(key)
+        if result is None:
+            result = self.dicts[key] = self.build_dict(is_declaration, types)
+        return result
 
-    def to_dict(self, is_declaration=False):
+    def reference(self, types=None):
+        """
+        Serialize a use of this type, as a `{"$ref": id}` into `types` if given.
+        """
+        if types is None:
+            return self.to_dict()
+        ref = self.dicts.get('$ref')
+        if ref is None:
+            d = self.to_dict(types=types)
+            ref_id = self.spelling
+            n = 1
+            while ref_id in types and types[ref_id] is not d and types[ref_id] != d:
+                n += 1
+                ref_id = f"{self.spelling}#{n}"
+            types.setdefault(ref_id, d)
+            ref = self.dicts['$ref'] = { '$ref': ref_id }
+        return ref
+
+    def build_dict(self, is_declaration, types):
         result = {
             'kind': self.kind,
             'spelling': self.spelling,
             'size': self.size,
         }
         if is_declaration:
-            if hasattr(self, 'fields'):
-                result['fields'] = [f.to_dict() for f in self.fields]
-            if hasattr(self, 'values'):
+            if self.fields is not None:
+                result['fields'] = [f.to_dict(types) for f in self.fields]
+            if self.values is not None:
                 result['values'] = [v.to_dict() for v in self.values]
         else:
             result['base'] = self.base
-        if hasattr(self, 'name'):
+        if self.name is not None:
             result['name'] = self.name
-        if hasattr(self, 'type'):
-            result['type'] = self.type.to_dict()
-        if hasattr(self, 'function'):
-            result['function'] = self.function.to_dict()
-        if hasattr(self, 'return_type'):
-            result['return_type'] = self.return_type.to_dict()
-        if hasattr(self, 'arguments'):
-            result['arguments'] = [a.to_dict() for a in self.arguments]
-        if hasattr(self, 'array'):
+        if self.type is not None:
+            result['type'] = self.type.reference(types)
+        if self.function is not None:
+            result['function'] = self.function.reference(types)
+        if self.return_type is not None:
+            result['return_type'] = self.return_type.reference(types)
+        if self.arguments is not None:
+            result['arguments'] = [a.reference(types) for a in self.arguments]
+        if self.array is not None:
             result['array'] = self.array
-        if self.is_anonymous():
+        if self.anonymous:
             result['anonymous'] = True
-        if self.is_variadic():
+        if self.variadic:
             result['variadic'] = True
         if self.const:
             result['const'] = True
@@ -271,18 +728,34 @@ class Type(Definition):
         return result
 
     @classmethod
-    def from_clang(cls, t):
-        if t.kind == clang.TypeKind.AUTO:
-            # process actual type
-            t = t.get_canonical()
-        if t.kind == clang.TypeKind.ELABORATED:
-            # just process inner type
-            t = t.get_named_type()
-        declaration = t.get_declaration()
-        the_type = cls.processed_types.get(declaration.hash)
-        if not the_type:
-            the_type = Type(t)
-        return the_type
+    def from_clang(cls, t, registry):
+        """
+        The `Type` for `t`, building it and every type it's made of that
+        wasn't processed yet. Types are built depth first with an explicit
+        stack of `build` generators, so deep typedef and pointer chains don't
+        run into the recursion limit.
+        """
+        root, build = registry.lookup(t)
+        if build is None:
+            registry.replay(root)
+        stack = [(root, build, len(registry.registered))] if build is not None else []
+        value = None
+        while stack:
+            the_type, build, start = stack[-1]
+            try:
+                child = build.send(value)
+            except StopIteration:
+                stack.pop()
+                registry.built(the_type, start)
+                value = the_type
+                continue
+            value, build = registry.lookup(child)
+            if build is not None:
+                stack.append((value, build, len(registry.registered)))
+                value = None
+            else:
+                registry.replay(value)
+        return root
 
     @staticmethod
     def process_pointer_or_array(t):
@@ -303,40 +776,46 @@ class Type(Definition):
 
 
 class Variable(Definition):
-    def __init__(self, cursor):
+    __slots__ = ('name', 'type')
+
+    def __init__(self, cursor, registry):
         super().__init__('var')
         self.name = cursor.spelling
-        self.type = Type.from_clang(cursor.type)
+        self.type = Type.from_clang(cursor.type, registry)
 
-    def to_dict(self, is_declaration=True):
+    def to_dict(self, is_declaration=True, types=None):
         return {
             'kind': self.kind,
             'name': self.name,
-            'type': self.type.to_dict(),
+            'type': self.type.reference(types),
         }
 
 
 class Constant(Definition):
-    def __init__(self, cursor, name):
+    __slots__ = ('name', 'type')
+
+    def __init__(self, cursor, name, registry):
         super().__init__('const')
         self.name = name
-        self.type = Type.from_clang(cursor.type)
+        self.type = Type.from_clang(cursor.type, registry)
 
-    def to_dict(self, is_declaration=True):
+    def to_dict(self, is_declaration=True, types=None):
         return {
             'kind': self.kind,
             'name': self.name,
-            'type': self.type.to_dict(),
+            'type': self.type.reference(types),
         }
 
 class AnonymousEnum(Definition):
+    __slots__ = ('name', 'value', 'size')
+
     def __init__(self, cursor, size):
         super().__init__('const')
         self.name = cursor.name
         self.value = cursor.value
         self.size = size
 
-    def to_dict(self, is_declaration=True):
+    def to_dict(self, is_declaration=True, types=None):
         d = {
             'kind': self.kind,
             'name': self.name,
@@ -346,30 +825,34 @@ class AnonymousEnum(Definition):
         return d
 
 class Function(Definition):
+    __slots__ = ('name', 'return_type', 'arguments', 'variadic')
+
     class Argument:
-        def __init__(self, cursor):
+        __slots__ = ('name', 'type')
+
+        def __init__(self, cursor, registry):
             self.name = cursor.spelling
-            self.type = Type.from_clang(cursor.type)
+            self.type = Type.from_clang(cursor.type, registry)
 
-        def to_dict(self):
+        def to_dict(self, types=None):
             return {
                 'name': self.name,
-                'type': self.type.to_dict(),
+                'type': self.type.reference(types),
             }
 
-    def __init__(self, cursor):
+    def __init__(self, cursor, registry):
         super().__init__('function')
         self.name = cursor.spelling
-        self.return_type = Type.from_clang(cursor.type.get_result())
-        self.arguments = [Function.Argument(a) for a in cursor.get_arguments()]
+        self.return_type = Type.from_clang(cursor.type.get_result(), registry)
+        self.arguments = [Function.Argument(a, registry) for a in cursor.get_arguments()]
         self.variadic = cursor.type.kind == clang.TypeKind.FUNCTIONPROTO and cursor.type.is_function_variadic()
 
-    def to_dict(self, is_declaration=True):
+    def to_dict(self, is_declaration=True, types=None):
         d = {
             'kind': self.kind,
             'name': self.name,
-            'return_type': self.return_type.to_dict(),
-            'arguments': [a.to_dict() for a in self.arguments]
+            'return_type': self.return_type.reference(types),
+            'arguments': [a.to_dict(types) for a in self.arguments]
         }
         if self.variadic:
             d['variadic'] = True
@@ -402,124 +885,675 @@ def base_type(spelling):
         print("FIXME: ", spelling)
     return (m.group(1) if m.group(3) else m.group(2)).strip() if m else spelling
 
+class DefinitionIndex:
+    """
+    Hash indexes over serialized definitions, built once so lookups by kind,
+    name, source file or referenced type don't rescan every definition. The
+    index of users, which walks every type, is only built when first needed.
+    """
+    def __init__(self, definitions, sources=None, types=None):
+        self.definitions = definitions
+        self.types = types
+        self.by_kind = {}
+        self.by_name = {}
+        self.by_source = {}
+        self.declarations = {}
+        self._users = None
+        for i, d in enumerate(definitions):
+            self.by_kind.setdefault(d['kind'], []).append(d)
+            self.by_name.setdefault(d['name'], []).append(d)
+            if sources:
+                self.by_source.setdefault(sources[i], []).append(d)
+            if d['kind'] in TYPE_DEFINITION_KINDS:
+                self.declarations.setdefault(d['spelling'], d)
+
+    @property
+    def users(self):
+        if self._users is None:
+            self._users = {}
+            for i, d in enumerate(self.definitions):
+                for ref in type_references(d, types=self.types):
+                    self._users.setdefault(ref, []).append(i)
+        return self._users
+
+    def users_of(self, type_name, transitive=False):
+        found = set(self.users.get(type_name, ()))
+        if transitive:
+            pending = list(found)
+            while pending:
+                d = self.definitions[pending.pop()]
+                if d['kind'] in TYPE_DEFINITION_KINDS:
+                    for i in self.users.get(d['spelling'], ()):
+                        if i not in found:
+                            found.add(i)
+                            pending.append(i)
+        return [self.definitions[i] for i in sorted(found)]
+
+
+class ConstantEvaluator:
+    """
+    Works out the type of the C constant expressions most object-like macros
+    expand to: literals, other macros and enum constants combined with
+    arithmetic, bitwise, comparison, logical and conditional operators,
+    following C's literal typing and usual arithmetic conversions.
+    Anything it can't prove to be a valid constant raises `NotConstant`.
+    """
+    INTEGER_TYPES = ('int', 'unsigned int', 'long', 'unsigned long', 'long long', 'unsigned long long')
+    FLOATING_TYPES = ('float', 'double', 'long double')
+    ESCAPES = { 'n': 10, 't': 9, 'v': 11, 'b': 8, 'r': 13, 'f': 12, 'a': 7, '\\': 92, "'": 39, '"': 34, '?': 63 }
+    BINARY_PRECEDENCE = {
+        '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6,
+        '<': 7, '>': 7, '<=': 7, '>=': 7, '<<': 8, '>>': 8,
+        '+': 9, '-': 9, '*': 10, '/': 10, '%': 10,
+    }
+    COMPARISONS = {
+        '==': operator.eq, '!=': operator.ne, '<': operator.lt,
+        '>': operator.gt, '<=': operator.le, '>=': operator.ge,
+    }
+    MAX_TOKENS = 4096
+
+    def __init__(self, macros, enum_constants, sizes):
+        """
+        `macros` maps object-like macros to their replacement tokens,
+        `enum_constants` maps `int` typed enum constants to their values and
+        `sizes` maps each of `INTEGER_TYPES` to its size in bytes.
+        """
+        self.macros = macros
+        self.enum_constants = enum_constants
+        self.bits = { t: sizes[t] * 8 for t in self.INTEGER_TYPES }
+        self.tokens = []
+        self.pos = 0
+
+    def type_of(self, identifier):
+        try:
+            self.tokens = self.expand([identifier], frozenset(), [])
+            self.pos = 0
+            t, _ = self.conditional()
+        except RecursionError:
+            raise NotConstant(identifier)
+        if self.pos != len(self.tokens):
+            raise NotConstant(identifier)
+        return t
+
+    def expand(self, tokens, hidden, result):
+        for token in tokens:
+            body = self.macros.get(token)
+            if body is not None and token not in hidden:
+                self.expand(body, hidden | {token}, result)
+            else:
+                result.append(token)
+            if len(result) > self.MAX_TOKENS:
+                raise NotConstant(token)
+        return result
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise NotConstant(token)
+        self.pos += 1
+
+    def conditional(self):
+        condition = self.binary(1)
+        if self.peek() != '?':
+            return condition
+        self.pos += 1
+        a = self.conditional()
+        self.expect(':')
+        b = self.conditional()
+        if condition[0] == 'string':
+            raise NotConstant('?')
+        t = self.common_type(a[0], b[0])
+        return t, self.convert((a if condition[1] else b)[1], t)
+
+    def binary(self, min_precedence):
+        left = self.unary()
+        while True:
+            op = self.peek()
+            precedence = self.BINARY_PRECEDENCE.get(op)
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.pos += 1
+            left = self.apply(op, left, self.binary(precedence + 1))
+
+    def unary(self):
+        op = self.peek()
+        if op not in ('+', '-', '~', '!'):
+            return self.primary()
+        self.pos += 1
+        t, value = self.unary()
+        if t == 'string' or (op == '~' and t in self.FLOATING_TYPES):
+            raise NotConstant(op)
+        if op == '!':
+            return 'int', int(not value)
+        if op == '+':
+            return t, value
+        return t, self.result(t, -value if op == '-' else ~value)
+
+    def primary(self):
+        token = self.peek()
+        if token is None:
+            raise NotConstant(token)
+        self.pos += 1
+        if token == '(':
+            value = self.conditional()
+            self.expect(')')
+            return value
+        if STRING_LITERAL_RE.fullmatch(token):
+            # adjacent string literals are concatenated
+            while self.peek() is not None and STRING_LITERAL_RE.fullmatch(self.peek()):
+                self.pos += 1
+            return 'string', None
+        if token in self.enum_constants:
+            return 'int', self.enum_constants[token]
+        m = INTEGER_LITERAL_RE.fullmatch(token)
+        if m:
+            hexadecimal, binary, octal, decimal, suffix = m.groups()
+            if hexadecimal is not None:
+                value = int(hexadecimal, 16)
+            elif binary is not None:
+                value = int(binary, 2)
+            elif octal is not None:
+                value = int(octal, 8)
+            else:
+                value = int(decimal)
+            return self.integer_literal_type(value, suffix, decimal is not None), value
+        m = FLOAT_LITERAL_RE.fullmatch(token)
+        if m:
+            value = float(m.group(1))
+            if not math.isfinite(value):
+                raise NotConstant(token)
+            return { '': 'double', 'f': 'float', 'l': 'long double' }[m.group(2).lower()], value
+        m = CHAR_LITERAL_RE.fullmatch(token)
+        if m:
+            plain, escape, octal, hexadecimal = m.groups()
+            if plain is not None:
+                value = ord(plain)
+            elif escape is not None:
+                value = self.ESCAPES[escape]
+            else:
+                value = int(octal, 8) if octal is not None else int(hexadecimal, 16)
+            if value > 127:
+                # depends on the signedness of char
+                raise NotConstant(token)
+            return 'int', value
+        raise NotConstant(token)
+
+    def integer_literal_type(self, value, suffix, decimal):
+        unsigned = 'u' in suffix.lower()
+        longs = len(suffix) - unsigned
+        for t in self.INTEGER_TYPES[2 * longs:]:
+            if self.is_unsigned(t) != unsigned and (unsigned or decimal):
+                continue
+            if self.fits(value, t):
+                if decimal and not unsigned and longs < 2 and t == 'long long':
+                    # C89 and C99 disagree on this one
+                    break
+                return t
+        raise NotConstant(value)
+
+    def is_unsigned(self, t):
+        return t.startswith('unsigned ')
+
+    def rank(self, t):
+        return self.INTEGER_TYPES.index(t) // 2
+
+    def fits(self, value, t):
+        bits = self.bits[t]
+        if self.is_unsigned(t):
+            return 0 <= value < 1 << bits
+        return -(1 << bits - 1) <= value < 1 << bits - 1
+
+    def result(self, t, value):
+        if t in self.FLOATING_TYPES:
+            if not math.isfinite(value):
+                raise NotConstant(value)
+            return value
+        if self.is_unsigned(t):
+            return value % (1 << self.bits[t])
+        if not self.fits(value, t):
+            # signed overflow
+            raise NotConstant(value)
+        return value
+
+    def convert(self, value, t):
+        if t in self.FLOATING_TYPES:
+            return float(value)
+        return self.result(t, value)
+
+    def common_type(self, a, b):
+        if a == 'string' or b == 'string':
+            raise NotConstant('string')
+        if a in self.FLOATING_TYPES or b in self.FLOATING_TYPES:
+            return max((t for t in (a, b) if t in self.FLOATING_TYPES), key=self.FLOATING_TYPES.index)
+        if a == b:
+            return a
+        if self.is_unsigned(a) == self.is_unsigned(b):
+            return a if self.rank(a) >= self.rank(b) else b
+        unsigned, signed = (a, b) if self.is_unsigned(a) else (b, a)
+        if self.rank(unsigned) >= self.rank(signed):
+            return unsigned
+        if self.bits[signed] > self.bits[unsigned]:
+            return signed
+        return 'unsigned ' + signed
+
+    def apply(self, op, left, right):
+        (lt, lv), (rt, rv) = left, right
+        if lt == 'string' or rt == 'string':
+            raise NotConstant(op)
+        if op == '&&':
+            return 'int', int(bool(lv) and bool(rv))
+        if op == '||':
+            return 'int', int(bool(lv) or bool(rv))
+        if op in ('<<', '>>'):
+            if lt in self.FLOATING_TYPES or rt in self.FLOATING_TYPES or not 0 <= rv < self.bits[lt]:
+                raise NotConstant(op)
+            if op == '>>':
+                return lt, lv >> rv
+            if lv < 0:
+                raise NotConstant(op)
+            return lt, self.result(lt, lv << rv)
+        t = self.common_type(lt, rt)
+        lv, rv = self.convert(lv, t), self.convert(rv, t)
+        if op in self.COMPARISONS:
+            return 'int', int(self.COMPARISONS[op](lv, rv))
+        if op in ('/', '%') and rv == 0:
+            raise NotConstant(op)
+        if t in self.FLOATING_TYPES:
+            if op in ('%', '&', '|', '^'):
+                raise NotConstant(op)
+            if op == '/':
+                return t, self.result(t, lv / rv)
+        elif op in ('/', '%'):
+            # C division truncates towards zero
+            quotient = abs(lv) // abs(rv)
+            if (lv < 0) != (rv < 0):
+                quotient = -quotient
+            return t, self.result(t, quotient if op == '/' else lv - rv * quotient)
+        value = {
+            '+': operator.add, '-': operator.sub, '*': operator.mul,
+            '&': operator.and_, '|': operator.or_, '^': operator.xor,
+        }[op](lv, rv)
+        return t, self.result(t, value)
+
+
 class Visitor:
-    def __init__(self, header_path, clang_path=None, libclang_path=None, clang_args=[], include_headers=[], include_patterns=[], exclude_patterns=[], type_objects=False, skip_defines=False, language="c"):
+    def __init__(self, header_path, clang_path=None, libclang_path=None, clang_args=[], include_headers=[], include_patterns=[], exclude_patterns=[], type_objects=False, skip_defines=False, language="c", macro_batch_size=0, jobs=1, probe_timeout=None, engine="clang", cache_dir=None, cache_size=256 * 1024 * 1024, watch=False, type_refs=False, stream=False, skip_bodies=False, evaluate_macros=True, hooks=None, reachable_only=False):
         if libclang_path:
-            if os.path.exists(libclang_path):
-                try:
-                    if os.path.isfile(libclang_path):
-                        clang.Config.set_library_file(libclang_path)
-                    else:
-                        clang.Config.set_library_path(libclang_path)
-                except clang.LibclangError as e: # Failed to load library
-                    print(f"ERROR: {str(e)}")
-                except: # Error occurs when library is already loaded, skip
-                    pass
-            else:
-                print(f"ERROR! Path \"{libclang_path}\" doesn't exist")
-                sys.exit(1)
+            load_libclang(libclang_path)
         self.defs = []
-        self.typedefs = {}
+        self._typedefs = None
+        self.registry = TypeRegistry(trace=watch)
         self.index = clang.Index.create()
         self.parsed_headers = set()
+        self.relative_paths = {}
+        self.included_files = {}
         self.potential_constants = []
+        self.macro_files = OrderedDict()
+        self.macro_definitions = {}
+        self.macro_bodies = {}
         self.clang_path = clang_path if clang_path else "clang"
-        def compile_all(patterns, default=None):
-            return [re.compile(p) for p in patterns] or default
-        self.include_patterns = compile_all(include_patterns)
-        self.exclude_patterns = compile_all(exclude_patterns)
+        self.include_patterns = combine_patterns(include_patterns)
+        self.exclude_patterns = combine_patterns(exclude_patterns)
         self.language = language
-
-        with tempfile.NamedTemporaryFile() as ast_file:
-            clang_stdout = self.run_clang(header_path, ['-emit-ast'] + clang_args)
-            ast_file.write(clang_stdout)
-            tu = self.index.read(ast_file.name)
-
-        include_headers = compile_all(include_headers, default=[MATCH_ALL_RE])
+        self.macro_batch_size = macro_batch_size
+        self.jobs = jobs
+        self.probe_timeout = probe_timeout
         self.type_objects = type_objects
         self.skip_defines = skip_defines
-        for cursor in tu.cursor.get_children():
-            self.process(cursor, include_headers)
-        type_defs = [t for t in Type.type_declarations.values() if self.test_definition(t.name)]
-        self.defs = type_defs + self.defs
-        if not skip_defines:
-            self.process_marked_macros(header_path, clang_args)
-        self._definitions = [d.to_dict(is_declaration=True) for d in self.defs]
-        self.typedefs = { x["name"]: x["type"]["spelling"] for x in self.typedef_definitions() }
+        self.evaluate_macros = evaluate_macros
+        self.hooks = hooks
+        self.reachable_only = reachable_only
+        self.header_path = header_path
+        self.clang_args = clang_args
+        self.watch = watch
+        if watch and type_refs:
+            raise ValueError("Watching for changes can't be combined with `type_refs`")
+        if stream and (watch or type_refs or reachable_only):
+            raise ValueError("Streaming definitions can't be combined with `watch`, `type_refs` or `reachable_only`")
+        self.type_table = OrderedDict() if type_refs else None
+        self.stream = stream
+        self.tu = None
+        self.sources = None
+        self._index = None
+
+        cache = ResultCache(cache_dir, cache_size) if cache_dir and not watch else None
+        self.pch_cache = ResultCache(cache_dir, cache_size) if cache_dir else None
+        self.clang_path_arg = clang_path
+        self.cache = self.cache_key = None
+        # set when a probe timed out, the results are incomplete then
+        self.timed_out = False
+        if cache:
+            cache_key = cache.key(os.path.abspath(header_path), os.getcwd(), file_digest(header_path),
+                                  clang_path, clang_args, language, engine, include_headers,
+                                  include_patterns, exclude_patterns, skip_defines, type_refs, skip_bodies,
+                                  evaluate_macros, reachable_only, stream, libclang_version(),
+                                  clang_version(self.clang_path))
+            with self.phase('cache'):
+                result = cache.load(cache_key)
+            self.count('cache_hits' if result is not None else 'cache_misses')
+            if result is not None:
+                # cache hit, there are no Definition objects behind these
+                self.stream = False
+                self._definitions = result['definitions']
+                self.sources = result['sources']
+                self.includes = [tuple(i) for i in result['includes']]
+                self.type_table = result['type_table']
+                self._typedefs = None
+                return
+            self.cache, self.cache_key = cache, cache_key
+
+        self.engine = self.resolve_engine(engine, clang_path)
+        if watch and self.engine != 'libclang':
+            raise ValueError("Watching for changes requires the `libclang` engine")
+
+        with self.phase('parse'):
+            if self.engine == 'libclang':
+                options = 0
+                if watch:
+                    options |= clang.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+                if skip_bodies:
+                    # only declarations are extracted, so function bodies needn't be parsed
+                    options |= clang.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+                if not skip_defines:
+                    # macro definitions are only visited with a detailed preprocessing record
+                    options |= clang.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+                # anonymous types are named after the path clang was given, so
+                # both engines are given an absolute one
+                tu = self.parse_clang(os.path.abspath(header_path), clang_args, options=options)
+            else:
+                record_args = [] if skip_defines else ['-Xclang', '-detailed-preprocessing-record']
+                tu = self.read_ast(self.run_clang(header_path, ['-emit-ast'] + record_args + clang_args))
 
-    def run_clang(self, header_path, clang_args=[], source=None):
+        self.include_headers = combine_patterns(include_headers) or [MATCH_ALL_RE]
+        if stream:
+            # traversal happens lazily in `iter_definitions`
+            self.tu = tu
+            return
+        cursor_keys = []
+        cursor_sources = []
+        counters = {}
+        with self.phase('traversal'):
+            for cursor in tu.cursor.get_children():
+                start = len(self.defs)
+                types_start = len(self.registry.registered)
+                self.process(cursor)
+                if len(self.defs) > start:
+                    cursor_sources.extend([self.source_path(cursor)] * (len(self.defs) - start))
+                if watch:
+                    cursor_keys.append((self.cursor_key(cursor, counters), declared_type(cursor), start, len(self.defs),
+                                        self.registered_types(types_start)))
+        declarations = [t for t in self.registry.type_declarations.values() if self.test_definition(t.name)]
+        constants_start = len(self.defs)
+        self.includes = [(self.relative_path(i.source.name), self.relative_path(i.include.name))
+                         for i in tu.get_includes()]
+        if not skip_defines:
+            with self.phase('macros'):
+                self.collect_macros()
+                self.process_marked_macros(header_path, clang_args)
+        type_defs = declarations
+        if reachable_only:
+            with self.phase('reachability'):
+                roots = [d.to_dict(is_declaration=True, types=self.type_table) for d in self.defs]
+                reached = reachable_declarations(roots, [
+                    (t.spelling, functools.partial(t.to_dict, is_declaration=True, types=self.type_table))
+                    for t in declarations ], self.type_table)
+                type_defs = [t for t in declarations if t.spelling in reached]
+        constants_start += len(type_defs)
+        self.defs = type_defs + self.defs
+        self.count_types()
+        with self.phase('serialize'):
+            self._definitions = [d.to_dict(is_declaration=True, types=self.type_table) for d in self.defs]
+        self.sources = [self.declaration_source(t) for t in type_defs] + cursor_sources
+        self.sources.extend(self.constant_sources({d.name for d in self.defs[constants_start:]}))
+        self._typedefs = None
+        if watch:
+            # keep the serialized definitions around by where they came from,
+            # so `update` only has to redo the ones from files that changed
+            self.tu = tu
+            self.dependency_mtimes = self.included_files_mtimes()
+            # unreached declarations are kept too, a later change may reach them
+            self.type_dicts = OrderedDict()
+            for t in declarations:
+                d = t.to_dict(is_declaration=True)
+                self.type_dicts[(t.kind, t.spelling)] = (self.declaration_source(t), d, type_references(d))
+            offset = len(type_defs)
+            self.cursor_dicts = OrderedDict()
+            # the type declarations processing each cursor registers, to put
+            # them back in the order of a fresh run after an update
+            self.cursor_types = {}
+            for key, declared, start, end, types in cursor_keys:
+                if key:
+                    dicts = self._definitions[offset + start:offset + end]
+                    self.cursor_dicts[key] = (dicts, declared, type_references(dicts))
+                    self.cursor_types[key] = types
+            self.constant_dicts = { d['name']: d for d in self._definitions[constants_start:] }
+        self.store_result(tu)
+
+    def store_result(self, tu):
+        """
+        Store the definitions in the cache, unless they're incomplete because
+        a probe timed out.
+        """
+        if not self.cache or self.timed_out:
+            return
+        dependencies = {os.path.abspath(self.header_path)}
+        dependencies.update(os.path.abspath(i.include.name) for i in tu.get_includes())
+        with self.phase('cache'):
+            self.cache.store(self.cache_key, sorted(dependencies), {
+                'definitions': self._definitions,
+                'sources': self.sources,
+                'includes': self.includes,
+                'type_table': self.type_table,
+            })
+
+    def phase(self, name):
+        """
+        Context manager timing a phase of the work with `hooks`, if any.
+        """
+        return self.hooks.phase(self, name) if self.hooks else contextlib.nullcontext()
+
+    def count(self, name, n=1):
+        if self.hooks and n:
+            self.hooks.count(self, name, n)
+
+    def count_types(self):
+        self.count('types_created', self.registry.created)
+        self.count('type_cache_hits', self.registry.hits)
+        self.registry.created = self.registry.hits = 0
+
+    def run_clang(self, header_path, clang_args=[], source=None, timeout=None):
         clang_cmd = [self.clang_path]
         clang_cmd.extend(clang_args)
         clang_cmd.extend(('-o', '-'))
         if source:
             clang_cmd.append('-')
         else:
-            clang_cmd.append(header_path)
-        stderr = subprocess.DEVNULL if source else None
+            clang_cmd.append(os.path.abspath(header_path))
+        stderr = subprocess.PIPE if source else None
         # print(clang_cmd)
-        clang_result = subprocess.run(clang_cmd, input=source, stdout=subprocess.PIPE, stderr=stderr)
+        self.count('clang_runs')
+        try:
+            clang_result = subprocess.run(clang_cmd, input=source, stdout=subprocess.PIPE, stderr=stderr, timeout=timeout)
+        except subprocess.TimeoutExpired as ex:
+            self.timed_out = True
+            raise ProbeTimeout(ex.stderr)
         if clang_result.returncode != 0:
             raise CompilationError(clang_result.stderr)
         return clang_result.stdout
 
+    def resolve_engine(self, engine, clang_path):
+        """
+        The `libclang` engine parses in-process, unless `clang_path` points at a
+        clang that doesn't match the loaded libclang, then the `clang` engine
+        (a subprocess per translation unit) is used instead.
+        """
+        if engine not in ('clang', 'libclang'):
+            raise ValueError(f"Unknown engine `{engine}`")
+        if engine == 'libclang' and clang_path:
+            clang_match = CLANG_VERSION_RE.search(clang_version(clang_path))
+            libclang_match = CLANG_VERSION_RE.search(libclang_version())
+            if not clang_match or not libclang_match or clang_match.group(1) != libclang_match.group(1):
+                print(f"WARNING: `{clang_path}` doesn't match the loaded libclang, falling back to the clang engine", file=sys.stderr)
+                return 'clang'
+        return engine
+
+    def parse_clang(self, path, clang_args=[], source=None, options=0):
+        """
+        In-process equivalent of `run_clang`, returning the parsed translation unit.
+        """
+        unsaved_files = [(path, source)] if source is not None else None
+        self.count('libclang_parses')
+        try:
+            tu = self.index.parse(path, args=clang_args, unsaved_files=unsaved_files, options=options)
+        except clang.TranslationUnitLoadError as ex:
+            raise CompilationError(str(ex).encode('utf-8'))
+        errors = [d for d in tu.diagnostics if d.severity >= clang.Diagnostic.Error]
+        if errors:
+            stderr = format_diagnostics(tu.diagnostics, path if source is not None else None)
+            if source is None:
+                print(stderr.decode('utf-8'), file=sys.stderr)
+            raise CompilationError(stderr)
+        return tu
+
     def test_definition(self, def_name):
-        if self.exclude_patterns:
-            if any(pattern.search(def_name) for pattern in self.exclude_patterns):
-                if self.include_patterns:
-                    return any(pattern.search(def_name) for pattern in self.include_patterns)
-                else:
-                    return False
-            else:
-                return True
-        else:
-            return True
+        if self.exclude_patterns and search_any(self.exclude_patterns, def_name):
+            return bool(self.include_patterns and search_any(self.include_patterns, def_name))
+        return True
 
-    def process(self, cursor, include_patterns):
-        try:
+    def relative_path(self, filename):
+        result = self.relative_paths.get(filename)
+        if result is None:
             cwd = Path.cwd()
-            filepath = PurePath(cursor.location.file.name)
+            filepath = PurePath(filename)
             if filepath.is_relative_to(cwd):
                 filepath = filepath.relative_to(cwd)
-            filepath = str(filepath)
-            if not any(pattern.search(filepath) for pattern in include_patterns):
-                return
-            if not self.skip_defines and filepath not in self.parsed_headers:
-                self.mark_macros(filepath)
-                self.parsed_headers.add(filepath)
-        except AttributeError:
-            return
+            result = self.relative_paths[filename] = str(filepath)
+        return result
 
-        if cursor.is_anonymous() and cursor.kind == clang.CursorKind.ENUM_DECL:
-            t = Type.from_clang(cursor.type)
-            for v in t.values:
-                if self.test_definition(v.name):
-                    self.defs.append(AnonymousEnum(v, t.size))
-        else:
-            if not self.test_definition(cursor.spelling):
-                return
+    def included_source(self, cursor):
+        """
+        The source path of `cursor`, or `None` if it isn't in a file matched by
+        `include_headers`. Each file is only matched once.
+        """
+        f = cursor.location.file
+        if not f:
+            return None
+        filename = f.name
+        try:
+            return self.included_files[filename]
+        except KeyError:
+            filepath = self.relative_path(filename)
+            if not search_any(self.include_headers, filepath):
+                filepath = None
+            self.included_files[filename] = filepath
+            return filepath
+
+    def source_path(self, cursor):
+        f = cursor.location.file
+        return self.relative_path(f.name) if f else None
+
+    def declaration_source(self, t):
+        return self.relative_path(t.file) if t.file else None
+
+    def cursor_key(self, cursor, counters):
+        """
+        Identify a top level cursor by its file and position among that file's
+        top level cursors, which stays stable across reparses while the file
+        doesn't change.
+        """
+        filepath = self.source_path(cursor)
+        if filepath is None:
+            return None
+        n = counters.get(filepath, 0)
+        counters[filepath] = n + 1
+        return (filepath, n)
+
+    def process(self, cursor):
+        if cursor.kind.is_preprocessing():
+            if cursor.kind == clang.CursorKind.MACRO_DEFINITION:
+                self.record_macro(cursor)
+            return
+        filepath = self.included_source(cursor)
+        if filepath is None:
+            return
+        if not self.skip_defines and filepath not in self.parsed_headers:
+            self.mark_macros(filepath)
+            self.parsed_headers.add(filepath)
+
+        with self.phase('traversal.types'):
+            if cursor.is_anonymous() and cursor.kind == clang.CursorKind.ENUM_DECL:
+                t = self.registry.from_clang(cursor.type)
+                for v in t.values:
+                    if self.test_definition(v.name):
+                        self.defs.append(AnonymousEnum(v, t.size))
+            else:
+                if not self.test_definition(cursor.spelling):
+                    return
 
-        if cursor.kind == clang.CursorKind.VAR_DECL:
-            new_definition = Variable(cursor)
-            self.defs.append(new_definition)
-        if cursor.kind in (clang.CursorKind.TYPEDEF_DECL, clang.CursorKind.ENUM_DECL, clang.CursorKind.STRUCT_DECL, clang.CursorKind.UNION_DECL):
-            self.process_type(cursor.type)
-        elif cursor.kind == clang.CursorKind.FUNCTION_DECL:
-            self.defs.append(Function(cursor))
+            if cursor.kind == clang.CursorKind.VAR_DECL:
+                new_definition = Variable(cursor, self.registry)
+                self.defs.append(new_definition)
+            if cursor.kind in (clang.CursorKind.TYPEDEF_DECL, clang.CursorKind.ENUM_DECL, clang.CursorKind.STRUCT_DECL, clang.CursorKind.UNION_DECL):
+                self.process_type(cursor.type)
+            elif cursor.kind == clang.CursorKind.FUNCTION_DECL:
+                self.defs.append(Function(cursor, self.registry))
 
     def process_type(self, t):
-        new_declaration = Type.from_clang(t)
+        new_declaration = self.registry.from_clang(t)
+
+    def record_macro(self, cursor):
+        """
+        Keep an object-like macro with a non-empty body from the preprocessing
+        record as a candidate constant, by the offset of its last definition,
+        if it's in an included file. Its replacement tokens are kept for
+        `evaluate_constants`, and for `update` to find the constants that
+        depend on it, either way.
+        """
+        filepath = self.included_source(cursor)
+        keep_body = self.evaluate_macros or self.watch
+        if filepath is None and not keep_body:
+            return
+        name = cursor.spelling
+        extent = cursor.extent
+        if extent.end.offset - extent.start.offset <= len(name):
+            return
+        tokens = cursor.get_tokens()
+        name_token = next(tokens)
+        first = next(tokens, None)
+        if first is None:
+            return
+        if first.spelling == '(' and first.extent.start.offset == name_token.extent.end.offset:
+            return  # function-like
+        if keep_body:
+            body = [first.spelling]
+            body.extend(t.spelling for t in tokens)
+            self.macro_bodies[name] = (self.source_path(cursor), body)
+        if filepath is not None:
+            self.macro_definitions.setdefault(filepath, OrderedDict())[name] = extent.start.offset
 
     def mark_macros(self, filepath):
-        with open(filepath) as f:
-            for line in f:
-                m = DEFINE_RE.match(line)
-                if m:
-                    self.potential_constants.append(m.group(1))
+        # filled in by `collect_macros`, once the whole file was traversed
+        self.macro_files[filepath] = None
+
+    def collect_macros(self):
+        """
+        Fill in the candidate constants of the files marked by `mark_macros`.
+        Macros `#undef`'d by the end of the header are only left out by
+        `process_marked_macros`, as the preprocessing record doesn't keep
+        `#undef`s.
+        """
+        for filepath, identifiers in self.macro_files.items():
+            if identifiers is not None:
+                continue
+            self.macro_files[filepath] = list(self.macro_definitions.get(filepath, {}))
+        self.potential_constants = [i for identifiers in self.macro_files.values() for i in identifiers]
 
     def process_marked_macros(self, header_path, clang_args=[]):
         with tempfile.NamedTemporaryFile(suffix='.pch') as pch_file:
-            clang_stdout = self.run_clang(header_path, ['-x', 'c++-header' if self.language in ["c++", "cplusplus"] else 'c-header', '-Xclang', '-emit-pch'] + clang_args)
-            pch_file.write(clang_stdout)
+            with self.phase('macros.pch'):
+                pch_path, pch_args = self.macro_pch(header_path, clang_args, pch_file)
 
             lang = self.language
             match self.language:
@@ -531,28 +1565,529 @@ class Visitor:
                     lang = "c++"
                 case _:
                     raise ValueError(f"Unknown language `{lang}`")
-            clang_args = ['-x', lang, '-emit-ast', '-include-pch', pch_file.name] + clang_args
-            for identifier in self.potential_constants:
-                if not self.test_definition(identifier):
-                    continue
+            clang_args = ['-x', lang, '-include-pch', pch_path] + pch_args + clang_args
+            if self.engine != 'libclang':
+                clang_args = ['-emit-ast'] + clang_args
+            with self.phase('macros.evaluate'):
+                undefined = self.undefined_macros(header_path, clang_args)
+                identifiers = [i for i in self.potential_constants if self.test_definition(i) and i not in undefined]
+                constants = self.evaluate_constants(header_path, identifiers, clang_args, undefined)
+            evaluated = len(constants)
+            self.count('macros_evaluated', evaluated)
+            probes = [(i, identifier) for i, identifier in enumerate(identifiers) if i not in constants]
+            with self.phase('macros.probes'):
+                if self.macro_batch_size > 0:
+                    batches = [probes[start:start + self.macro_batch_size]
+                               for start in range(0, len(probes), self.macro_batch_size)]
+                    clang_args = ['-ferror-limit=0'] + clang_args
+                    compile_batch = lambda batch: self.compile_macro_batch(header_path, batch, clang_args)
+                    for compiled in self.map_probes(compile_batch, batches):
+                        for ast, batch in compiled:
+                            names = {'__value_{}'.format(i): (i, identifier) for i, identifier in batch}
+                            for cursor in self.read_ast(ast).cursor.get_children():
+                                if cursor.kind == clang.CursorKind.VAR_DECL and cursor.spelling in names:
+                                    i, identifier = names[cursor.spelling]
+                                    constants[i] = Constant(cursor, identifier, self.registry)
+                else:
+                    compile_macro = lambda probe: self.compile_macro(header_path, probe[1], clang_args)
+                    for (i, identifier), ast in zip(probes, self.map_probes(compile_macro, probes)):
+                        if ast is None:
+                            # this macro is not a const value, skip
+                            continue
+                        for cursor in self.read_ast(ast).cursor.get_children():
+                            if cursor.kind == clang.CursorKind.VAR_DECL and cursor.spelling == '__value':
+                                constants[i] = Constant(cursor, identifier, self.registry)
+            succeeded = len(constants) - evaluated
+            self.count('probes_succeeded', succeeded)
+            self.count('probes_failed', len(probes) - succeeded)
+            self.defs.extend(constants[i] for i in sorted(constants))
+
+    def macro_pch(self, header_path, clang_args, pch_file):
+        """
+        Precompile the header the macro probes include into `pch_file`, or
+        reuse the one in the cache built from the same header, includes,
+        arguments and compiler. Returns the path of the PCH and the arguments
+        to use it with.
+        """
+        if self.pch_cache:
+            dependencies = sorted({ os.path.abspath(header_path) } |
+                                  { os.path.abspath(included) for _, included in self.includes })
+            # `-fno-validate-pch` below trusts this key to cover everything the
+            # PCH depends on: with `ResultCache.key` that includes the include
+            # path environment variables, and here the clang binary and version
+            key = self.pch_cache.key('pch', os.path.abspath(header_path), os.getcwd(), self.clang_path_arg,
+                                     shutil.which(self.clang_path), clang_args, self.language, self.engine,
+                                     self.compiler_version())
+            cached = self.pch_cache.load_file(key, '.pch')
+            self.count('pch_cache_hits' if cached else 'pch_cache_misses')
+            if cached:
+                # the cache already checked the contents of everything it includes,
+                # clang would also reject it for files that were only touched
+                return cached, ['-Xclang', '-fno-validate-pch']
+        pch_args = ['-x', 'c++-header' if self.language in ["c++", "cplusplus"] else 'c-header']
+        if self.engine == 'libclang':
+            self.parse_clang(os.path.abspath(header_path), pch_args + clang_args).save(pch_file.name)
+        else:
+            pch_file.write(self.run_clang(header_path, pch_args + ['-Xclang', '-emit-pch'] + clang_args))
+            pch_file.flush()
+        if self.pch_cache:
+            self.pch_cache.store_file(key, dependencies, pch_file.name, '.pch')
+        return pch_file.name, []
+
+    def compiler_version(self):
+        if self.engine == 'libclang':
+            return libclang_version()
+        return clang_version(self.clang_path)
+
+    def undefined_macros(self, header_path, clang_args):
+        """
+        The macros with a definition in the preprocessing record that are no
+        longer defined at the end of the header. Only macros some included
+        file has an `#undef` for are checked, with a single probe, since the
+        `#undef` may well be in a branch that isn't compiled.
+        """
+        files = [self.header_path]
+        files.extend(included for _, included in self.includes)
+        names = set()
+        for filepath in OrderedDict.fromkeys(files):
+            with open(filepath, 'rb') as f:
+                names.update(m.group(1).decode('utf-8') for m in UNDEF_RE.finditer(f.read()))
+        names = sorted(name for name in names if name in self.macro_bodies or
+                       any(name in definitions for definitions in self.macro_definitions.values()))
+        if not names:
+            return set()
+        lines = ['#include "{}"'.format(header_path)]
+        for i, name in enumerate(names):
+            lines.extend(('#ifndef {}'.format(name), 'int __undefined_{};'.format(i), '#endif'))
+        try:
+            ast = self.compile_probe(header_path, clang_args, '\n'.join(lines))
+        except CompilationError:
+            return set(names)
+        return { names[int(cursor.spelling[len('__undefined_'):])]
+                 for cursor in self.read_ast(ast).cursor.get_children()
+                 if cursor.kind == clang.CursorKind.VAR_DECL and cursor.spelling.startswith('__undefined_') }
+
+    def evaluate_constants(self, header_path, identifiers, clang_args, undefined=()):
+        """
+        Find the macros among `identifiers` that `ConstantEvaluator` can
+        prove are constants, without probing each of them with clang.
+        Returns `{index: Constant}`. Their types are taken from a single probe
+        of one literal of each type the evaluator can produce, so they're
+        exactly what clang gives the macros themselves. The `undefined`
+        macros aren't expanded.
+        """
+        if not self.evaluate_macros or not identifiers or self.language not in ('c', 'objc', 'objective-c'):
+            return {}
+        if any(arg.startswith(('-Werror', '-pedantic-errors')) for arg in self.clang_args):
+            # warnings about the expressions would fail their probes
+            return {}
+        type_names = list(TYPE_LITERALS)
+        type_cursors = {}
+        literal_probes = list(enumerate(TYPE_LITERALS.values()))
+        for ast, batch in self.compile_macro_batch(header_path, literal_probes, ['-ferror-limit=0'] + clang_args):
+            for cursor in self.read_ast(ast).cursor.get_children():
+                if cursor.kind == clang.CursorKind.VAR_DECL and cursor.spelling.startswith('__value_'):
+                    type_cursors[type_names[int(cursor.spelling[len('__value_'):])]] = cursor
+        if not all(t in type_cursors for t in ConstantEvaluator.INTEGER_TYPES):
+            return {}
+
+        evaluator = ConstantEvaluator(
+            { name: body for name, (_, body) in self.macro_bodies.items() if name not in undefined },
+            { v.name: v.value for t in self.registry.type_declarations.values() if t.kind == 'enum'
+              for v in t.values if v.int_typed },
+            { t: type_cursors[t].type.get_canonical().get_size() for t in ConstantEvaluator.INTEGER_TYPES })
+        constants = {}
+        for i, identifier in enumerate(identifiers):
+            try:
+                cursor = type_cursors.get(evaluator.type_of(identifier))
+            except NotConstant:
+                continue
+            if cursor is not None:
+                constants[i] = Constant(cursor, identifier, self.registry)
+        return constants
+
+    def map_probes(self, fn, items):
+        """
+        Lazily map `fn` over `items`, running up to `self.jobs` calls at once.
+        Results are yielded in the same order as `items`.
+        """
+        if self.jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                yield from executor.map(fn, items)
+        else:
+            yield from map(fn, items)
+
+    def compile_probe(self, header_path, clang_args, source):
+        """
+        Compile a macro probe source, returning either the serialized AST
+        (clang engine) or the translation unit itself (libclang engine).
+        """
+        if self.engine == 'libclang':
+            parse = lambda: self.parse_clang(PROBE_FILENAME, clang_args, source,
+                                             options=clang.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
+            if self.probe_timeout is None:
+                return parse()
+            # libclang can't be interrupted, so a probe that runs out of time is
+            # left to finish on its own thread and given up on like a clang one
+            result = {}
+            def run():
                 try:
-                    source = '#include "{}"\nconst auto __value = {};'.format(header_path, identifier)
-                    with tempfile.NamedTemporaryFile() as ast_file:
-                        clang_stdout = self.run_clang(header_path, clang_args, source.encode('utf-8'))
-                        ast_file.write(clang_stdout)
-                        tu = self.index.read(ast_file.name)
-                    for cursor in tu.cursor.get_children():
-                        if cursor.kind == clang.CursorKind.VAR_DECL and cursor.spelling == '__value':
-                            self.defs.append(Constant(cursor, identifier))
+                    result['tu'] = parse()
                 except CompilationError as ex:
+                    result['error'] = ex
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(self.probe_timeout)
+            if thread.is_alive():
+                self.timed_out = True
+                raise ProbeTimeout(b"")
+            if 'error' in result:
+                raise result['error']
+            return result['tu']
+        return self.run_clang(header_path, clang_args, source.encode('utf-8'), timeout=self.probe_timeout)
+
+    def read_ast(self, ast):
+        if isinstance(ast, clang.TranslationUnit):
+            return ast
+        self.count('ast_reads')
+        with tempfile.NamedTemporaryFile() as ast_file:
+            ast_file.write(ast)
+            ast_file.flush()
+            return self.index.read(ast_file.name)
+
+    def compile_macro(self, header_path, identifier, clang_args):
+        source = '#include "{}"\nconst auto __value = {};'.format(header_path, identifier)
+        try:
+            return self.compile_probe(header_path, clang_args, source)
+        except CompilationError:
+            return None
+
+    def compile_macro_batch(self, header_path, batch, clang_args):
+        """
+        Compile a batch of `(index, identifier)` macro probes in a single translation unit.
+        When clang reports errors, the probes they were reported on are
+        dropped and the rest of the batch is retried. A broken probe (say a
+        macro expanding to `{`) can make clang report an error on the next
+        one too, so a failed probe right after another one is probed again on
+        its own. A batch whose errors can't be traced back to its probes is
+        split in half, down to probes on their own, which are dropped if they
+        still fail. A batch that times out is dropped whole.
+        Returns a list of `(ast, batch)` for every sub-batch that compiled.
+        """
+        compiled = []
+        while batch:
+            lines = ['#include "{}"'.format(header_path)]
+            lines.extend('const auto __value_{} = {};'.format(i, identifier) for i, identifier in batch)
+            # errors at the end of the input (an unclosed `{`) land on the last token, keep it off the probes
+            lines.append('typedef int __cj_probes_end;')
+            try:
+                ast = self.compile_probe(header_path, clang_args, '\n'.join(lines))
+            except ProbeTimeout:
+                # smaller batches would only time out again, one after the other
+                break
+            except CompilationError as ex:
+                # probe N lives on line N + 2, right after the #include
+                failed = {int(m.group(1)) - 2 for m in PROBE_ERROR_RE.finditer(ex.args[0] or b'')}
+                remaining = [probe for n, probe in enumerate(batch) if n not in failed]
+                if len(remaining) < len(batch):
+                    for n in sorted(failed):
+                        if n - 1 in failed and n < len(batch):
+                            # possibly only broken by the probe before it
+                            compiled.extend(self.compile_macro_batch(header_path, [batch[n]], clang_args))
+                    batch = remaining
+                elif len(batch) > 1:
+                    half = len(batch) // 2
+                    compiled.extend(self.compile_macro_batch(header_path, batch[:half], clang_args))
+                    batch = batch[half:]
+                else:
                     # this macro is not a const value, skip
-                    pass
+                    break
+                continue
+            compiled.append((ast, batch))
+            break
+        return compiled
+
+    def constant_sources(self, found):
+        """
+        Files of the macros that turned out to be constants, in the same order
+        `process_marked_macros` produces them.
+        """
+        return [filepath for filepath, identifiers in self.macro_files.items()
+                for identifier in identifiers if identifier in found and self.test_definition(identifier)]
+
+    def included_files_mtimes(self):
+        files = [self.tu.spelling]
+        files.extend(i.include.name for i in self.tu.get_includes())
+        return { f: file_mtime(f) for f in files }
+
+    def stale(self):
+        """
+        Whether any file the translation unit includes changed on disk since
+        it was last parsed.
+        """
+        return any(file_mtime(f) != mtime for f, mtime in self.dependency_mtimes.items())
+
+    def update(self):
+        """
+        Reparse the translation unit if any file it includes changed on disk,
+        redoing only the definitions that come from changed files.
+        Returns whether the definitions were updated.
+        """
+        if not self.watch:
+            raise ValueError("Visitor was not created with `watch=True`")
+        changed = [f for f, mtime in self.dependency_mtimes.items() if file_mtime(f) != mtime]
+        if not changed:
+            return False
+        with self.phase('parse'):
+            self.tu.reparse()
+        self.dependency_mtimes = self.included_files_mtimes()
+        errors = [d for d in self.tu.diagnostics if d.severity >= clang.Diagnostic.Error]
+        if errors:
+            print(format_diagnostics(errors).decode('utf-8'), file=sys.stderr)
+            return False
+        changed = {self.relative_path(f) for f in changed}
+        # types declared in changed files, and everything that refers to them,
+        # may have changed shape or size
+        dirty = {spelling for (_, spelling), (source, _, _) in self.type_dicts.items() if source in changed}
+        while True:
+            referrers = {spelling for (_, spelling), (_, _, refs) in self.type_dicts.items()
+                         if spelling not in dirty and refs & dirty}
+            if not referrers:
+                break
+            dirty |= referrers
+
+        # declaration hashes don't survive a reparse, start from a fresh registry
+        self.registry.release()
+        self.defs = []
+        self.parsed_headers.difference_update(changed)
+        # names the changed files used to define, constants elsewhere may expand to them
+        names = {name for name, (filepath, _) in self.macro_bodies.items() if filepath in changed}
+        for filepath in changed:
+            names.update(self.macro_definitions.pop(filepath, ()))
+        self.macro_bodies = { name: (filepath, body) for name, (filepath, body) in self.macro_bodies.items()
+                              if filepath not in changed }
+        cursor_dicts = OrderedDict()
+        cursor_types = {}
+        counters = {}
+        with self.phase('traversal'):
+            for cursor in self.tu.cursor.get_children():
+                key = self.cursor_key(cursor, counters)
+                if key is None:
+                    continue
+                if key[0] not in changed and key in self.cursor_dicts:
+                    dicts, declared, refs = self.cursor_dicts[key]
+                    if declared not in dirty and not refs & dirty:
+                        cursor_dicts[key] = self.cursor_dicts[key]
+                        cursor_types[key] = self.cursor_types[key]
+                        continue
+                start = len(self.defs)
+                types_start = len(self.registry.registered)
+                self.process(cursor)
+                dicts = [d.to_dict(is_declaration=True) for d in self.defs[start:]]
+                cursor_dicts[key] = (dicts, declared_type(cursor), type_references(dicts))
+                cursor_types[key] = self.registered_types(types_start)
+
+        new_types = OrderedDict(((t.kind, t.spelling), t) for t in self.registry.type_declarations.values()
+                                if self.test_definition(t.name))
+        type_dicts = OrderedDict()
+        for key, (source, d, refs) in self.type_dicts.items():
+            t = new_types.get(key)
+            if t is not None and (source in changed or key[1] in dirty or self.declaration_source(t) in changed):
+                d = t.to_dict(is_declaration=True)
+                type_dicts[key] = (self.declaration_source(t), d, type_references(d))
+            elif source not in changed:
+                type_dicts[key] = (source, d, refs)
+        for key, t in new_types.items():
+            if key not in type_dicts:
+                d = t.to_dict(is_declaration=True)
+                type_dicts[key] = (self.declaration_source(t), d, type_references(d))
+        # in the order a fresh run would register them
+        order = OrderedDict((key, None) for types in cursor_types.values() for key in types if key in type_dicts)
+        order.update((key, None) for key in type_dicts)
+        type_dicts = OrderedDict((key, type_dicts[key]) for key in order)
+
+        self.includes = [(self.relative_path(i.source.name), self.relative_path(i.include.name))
+                         for i in self.tu.get_includes()]
+        self.collect_macros()
+        # constants in other files are redone too when they expand to a name
+        # the changed files define, or to a type that changed with them,
+        # directly or through other macros
+        names.update(name for name, (filepath, _) in self.macro_bodies.items() if filepath in changed)
+        for dicts in (self.type_dicts, type_dicts):
+            for (_, spelling), (source, d, _) in dicts.items():
+                if source in changed or spelling in dirty:
+                    names.add(d.get('name'))
+                    names.update(v['name'] for v in d.get('values') or ())
+        for dicts in (self.cursor_dicts, cursor_dicts):
+            names.update(d.get('name') for key, (ds, _, _) in dicts.items() if key[0] in changed for d in ds)
+        stale = {i for f in changed for i in self.macro_files.get(f, ())}
+        while True:
+            dependents = {name for name, (_, body) in self.macro_bodies.items()
+                          if name not in stale and not names.isdisjoint(body)}
+            if not dependents:
+                break
+            stale |= dependents
+            names |= dependents
+        self.potential_constants = [i for identifiers in self.macro_files.values() for i in identifiers if i in stale]
+        if self.potential_constants:
+            self.defs = []
+            with self.phase('macros'):
+                self.process_marked_macros(self.header_path, self.clang_args)
+            for identifier in self.potential_constants:
+                self.constant_dicts.pop(identifier, None)
+            self.constant_dicts.update((d.name, d.to_dict(is_declaration=True)) for d in self.defs)
+        self.potential_constants = [i for identifiers in self.macro_files.values() for i in identifiers]
+        constants = [self.constant_dicts[i] for i in self.potential_constants
+                     if i in self.constant_dicts and self.test_definition(i)]
+
+        self.type_dicts = type_dicts
+        self.cursor_dicts = cursor_dicts
+        self.cursor_types = cursor_types
+        emitted = list(type_dicts.values())
+        if self.reachable_only:
+            roots = [d for dicts, _, _ in cursor_dicts.values() for d in dicts] + constants
+            reached = reachable_declarations(roots, [(key[1], lambda d=d: d) for key, (_, d, _) in type_dicts.items()])
+            emitted = [v for key, v in type_dicts.items() if key[1] in reached]
+        self._definitions = [d for _, d, _ in emitted]
+        self._definitions.extend(d for dicts, _, _ in cursor_dicts.values() for d in dicts)
+        self._definitions.extend(constants)
+        self.sources = [source for source, _, _ in emitted]
+        self.sources.extend(key[0] for key, (dicts, _, _) in cursor_dicts.items() for _ in dicts)
+        self.sources.extend(self.constant_sources(self.constant_dicts))
+        self._typedefs = None
+        self.count_types()
+        return True
+
+    def registered_types(self, start):
+        return [(t.kind, t.spelling) for t in self.registry.registered[start:]]
+
+    def release(self):
+        """
+        Drop the type registry, definition objects and libclang handles,
+        keeping only the serialized definitions.
+        """
+        self.registry.release()
+        self.defs = []
+        self.index = None
+        self.tu = None
+        self.watch = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def iter_definitions(self):
+        """
+        Iterate over the serialized definitions. With `stream=True` these are
+        produced while traversing the translation unit instead of being kept
+        in memory: each type declaration right before the first definition
+        that needs it, and constants found from macros last. A stream can only
+        be iterated once.
+        """
+        if not self.stream:
+            yield from self._definitions
+            return
+        if self.tu is None:
+            raise ValueError("Definitions were already streamed")
+        tu, self.tu = self.tu, None
+        declarations = self.registry.type_declarations
+        n_declarations = 0
+        # kept for the cache, which has streams in their own order
+        dicts, sources = [], []
+        for cursor in tu.cursor.get_children():
+            self.process(cursor)
+            if len(declarations) > n_declarations:
+                new_types = list(itertools.islice(reversed(declarations.values()), len(declarations) - n_declarations))
+                n_declarations = len(declarations)
+                for t in reversed(new_types):
+                    if self.test_definition(t.name):
+                        d = t.to_dict(is_declaration=True)
+                        if self.cache:
+                            dicts.append(d)
+                            sources.append(self.declaration_source(t))
+                        yield d
+            for definition in self.defs:
+                d = definition.to_dict(is_declaration=True)
+                if self.cache:
+                    dicts.append(d)
+                    sources.append(self.source_path(cursor))
+                yield d
+            self.defs = []
+        self.includes = [(self.relative_path(i.source.name), self.relative_path(i.include.name))
+                         for i in tu.get_includes()]
+        if not self.skip_defines:
+            with self.phase('macros'):
+                self.collect_macros()
+                self.process_marked_macros(self.header_path, self.clang_args)
+            for definition in self.defs:
+                d = definition.to_dict(is_declaration=True)
+                if self.cache:
+                    dicts.append(d)
+                yield d
+            if self.cache:
+                sources.extend(self.constant_sources({definition.name for definition in self.defs}))
+            self.defs = []
+        self.count_types()
+        if self.cache:
+            self._definitions = dicts
+            self.sources = sources
+            self.store_result(tu)
+
+    def resolve(self, d):
+        """
+        Follow a `{"$ref": id}` type reference into the type table.
+        """
+        return self.type_table[d['$ref']] if '$ref' in d else d
 
     def all_definitions(self):
+        if self.stream:
+            self._definitions = list(self.iter_definitions())
+            self.stream = False
+            self._typedefs = None
         return self._definitions
 
+    def definition_index(self):
+        definitions = self.all_definitions()
+        if self._index is None or self._index.definitions is not definitions:
+            self._index = DefinitionIndex(definitions, self.sources, self.type_table)
+        return self._index
+
     def find_definitions_by(self, key, value):
-        return [x for x in self._definitions if x[key] == value]
+        if key == 'kind':
+            return list(self.definition_index().by_kind.get(value, ()))
+        if key == 'name':
+            return list(self.definition_index().by_name.get(value, ()))
+        return [x for x in self.all_definitions() if x[key] == value]
+
+    def find_definition(self, name, kind=None):
+        """
+        The first definition called `name`, optionally of the given `kind`.
+        """
+        for d in self.definition_index().by_name.get(name, ()):
+            if kind is None or d['kind'] == kind:
+                return d
+        return None
+
+    def find_declaration(self, type_name):
+        """
+        The struct, union, enum or typedef declaration for a type spelling,
+        like the `base` of a type, e.g. `struct point` or `point_t`.
+        """
+        return self.definition_index().declarations.get(type_name)
+
+    def definitions_in(self, source):
+        return list(self.definition_index().by_source.get(source, ()))
+
+    def users_of(self, type_name, transitive=False):
+        """
+        Definitions that refer to `type_name` anywhere in their types, e.g.
+        functions taking or returning it. With `transitive`, definitions that
+        use it through other declarations, like typedefs or struct fields,
+        are included too.
+        """
+        return self.definition_index().users_of(type_name, transitive)
 
     def definitions_by_kind(self, kind):
         return self.find_definitions_by('kind', kind)
@@ -569,6 +2104,13 @@ class Visitor:
     def function_definitions(self):
         return self.definitions_by_kind('function')
 
+    @property
+    def typedefs(self):
+        # built on first use, like the definition index it's looked up in
+        if self._typedefs is None:
+            self._typedefs = { x["name"]: self.resolve(x["type"])["spelling"] for x in self.typedef_definitions() }
+        return self._typedefs
+
     def has_typedef(self, name):
         return name in self.typedefs.keys()
 
@@ -577,11 +2119,824 @@ class Visitor:
 
 
 def defs(*args, **kwargs):
-    return Visitor(*args, **kwargs).all_definitions()
+    with Visitor(*args, **kwargs) as visitor:
+        return visitor.all_definitions()
 
-if __name__ == '__main__':
+def umbrella(headers, **kwargs):
+    """
+    Parse `headers` as a single umbrella translation unit, so the files they
+    share are parsed and serialized only once. Returns a shared table of type
+    declarations and, for each header, the definitions that come from it or
+    from files it was the first to include.
+    """
+    paths = [os.path.abspath(h) for h in headers]
+    source = ''.join('#include "{}"\n'.format(p) for p in paths)
+    cache_dir = kwargs.get('cache_dir')
+    cache = ResultCache(cache_dir, kwargs.get('cache_size', 256 * 1024 * 1024)) if cache_dir else None
+    if cache:
+        # the umbrella file itself is temporary, so the result is cached on the headers instead
+        if kwargs.get('libclang_path'):
+            load_libclang(kwargs['libclang_path'])
+        options = { k: v for k, v in kwargs.items() if k not in ('hooks', 'cache_dir', 'cache_size') }
+        cache_key = cache.key('umbrella', os.getcwd(), paths, options, libclang_version(),
+                              clang_version(kwargs.get('clang_path') or "clang"))
+        result = cache.load(cache_key)
+        if result is not None:
+            return result
+    with tempfile.NamedTemporaryFile('w', prefix='cj-umbrella-', suffix='.h') as f:
+        f.write(source)
+        f.flush()
+        visitor = Visitor(f.name, **dict(kwargs, cache_dir=None))
+        visitor.release()
+
+    owners = { visitor.relative_path(p): h for p, h in zip(paths, headers) }
+    for includer, included in visitor.includes:
+        if included not in owners and includer in owners:
+            owners[included] = owners[includer]
+    result = {
+        'types': [],
+        'headers': OrderedDict((h, []) for h in headers),
+    }
+    if visitor.type_table is not None:
+        result['type_table'] = visitor.type_table
+    for d, source in zip(visitor.all_definitions(), visitor.sources):
+        if d['kind'] in TYPE_DEFINITION_KINDS:
+            result['types'].append(d)
+        else:
+            result['headers'][owners.get(source, headers[0])].append(d)
+    if cache and not visitor.timed_out:
+        dependencies = set(paths)
+        dependencies.update(os.path.abspath(included) for _, included in visitor.includes)
+        cache.store(cache_key, sorted(dependencies), result)
+    return result
+
+def resolve_refs(d, types):
+    """
+    Copy a serialized definition with its `{"$ref": id}` references into
+    `types` replaced by the types they refer to.
+    """
+    if isinstance(d, dict):
+        if '$ref' in d:
+            return resolve_refs(types[d['$ref']], types)
+        return { k: resolve_refs(v, types) for k, v in d.items() }
+    if isinstance(d, list):
+        return [resolve_refs(v, types) for v in d]
+    return d
+
+def load_extraction(path):
+    """
+    Read the definitions back from any output of cj: JSON, with or without a
+    `type_table`, from `--umbrella`, newline delimited JSON or a `--sqlite`
+    database (all of its headers). Types are always nested objects.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'SQLite format 3\0'):
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            return [json.loads(row[0]) for row in
+                    connection.execute("SELECT json FROM definitions ORDER BY header_id, position")]
+    try:
+        result = json.loads(data)
+    except ValueError:
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+    if isinstance(result, dict):
+        types = result.get('type_table')
+        if 'headers' in result:
+            definitions = result['types'] + [d for ds in result['headers'].values() for d in ds]
+        else:
+            definitions = result['definitions']
+        result = [resolve_refs(d, types) for d in definitions] if types else definitions
+    return result
+
+def fingerprint(d):
+    return hashlib.sha256(json.dumps(d, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def describe_type(t):
+    return t.get('spelling') if isinstance(t, dict) else t
+
+def diff_members(old, new, key='name'):
+    """
+    Compare two lists of fields, arguments or enum values by name.
+    """
+    old_members = { m.get(key): m for m in old }
+    new_members = { m.get(key): m for m in new }
+    result = OrderedDict()
+    added = [name for name in new_members if name not in old_members]
+    removed = [name for name in old_members if name not in new_members]
+    changed = [name for name, m in new_members.items() if name in old_members and old_members[name] != m]
+    if added:
+        result['added'] = added
+    if removed:
+        result['removed'] = removed
+    if changed:
+        result['changed'] = changed
+    if not result and [m.get(key) for m in old] != [m.get(key) for m in new]:
+        result['reordered'] = True
+    return result
+
+def diff_arguments(old, new):
+    """
+    Compare two lists of function arguments by position, as their names
+    don't matter to callers.
+    """
+    result = OrderedDict()
+    if len(old) != len(new):
+        result['count'] = [len(old), len(new)]
+    changed = [{ 'position': i, 'type': [describe_type(a['type']), describe_type(b['type'])] }
+               for i, (a, b) in enumerate(zip(old, new)) if a['type'] != b['type']]
+    renamed = [[a['name'], b['name']] for a, b in zip(old, new) if a['name'] != b['name']]
+    if changed:
+        result['changed'] = changed
+    if renamed:
+        result['renamed'] = renamed
+    return result
+
+def diff_definition(old, new):
+    """
+    Describe how a definition changed between two extractions, and whether
+    the change breaks binary compatibility: anything that moves, resizes or
+    retypes memory or calls, or renumbers existing enum values, does.
+    """
+    changes = OrderedDict()
+    for key in OrderedDict.fromkeys(list(old) + list(new)):
+        a, b = old.get(key), new.get(key)
+        if a == b:
+            continue
+        if key == 'arguments' and new['kind'] == 'function':
+            changes[key] = diff_arguments(a or [], b or [])
+        elif key in ('fields', 'values', 'arguments'):
+            changes[key] = diff_members(a or [], b or [])
+        elif key in ('type', 'return_type'):
+            changes[key] = [describe_type(a), describe_type(b)]
+            if isinstance(a, dict) and isinstance(b, dict) and a.get('size') != b.get('size'):
+                changes[key + '_size'] = [a.get('size'), b.get('size')]
+        else:
+            changes[key] = [a, b]
+    kind = new['kind']
+    if kind == 'enum':
+        values = changes.get('values', {})
+        abi = 'size' in changes or 'type' in changes or bool(values.get('removed') or values.get('changed'))
+    elif kind == 'function':
+        arguments = changes.get('arguments', {})
+        abi = 'return_type' in changes or 'variadic' in changes or 'count' in arguments or 'changed' in arguments
+    elif kind == 'const':
+        abi = 'type' in changes or 'value' in changes or 'size' in changes
+    else:
+        abi = bool(set(changes) - {'spelling', 'name'}) or old.get('kind') != kind
+    return changes, abi
+
+def diff(old, new):
+    """
+    Compare two lists of serialized definitions, matched by kind and name,
+    telling apart definitions that changed by their `fingerprint`. Returns
+    what was added, removed and changed, with changes marked `abi` when they
+    break binary compatibility.
+    """
+    def by_key(definitions):
+        result = OrderedDict()
+        anonymous = {}
+        for d in definitions:
+            if d.get('anonymous'):
+                # their names come from where they're declared, match them up in order instead
+                anonymous[d['kind']] = anonymous.get(d['kind'], 0) + 1
+                key = (d['kind'], None, anonymous[d['kind']])
+            else:
+                key = (d['kind'], d.get('name'))
+            n = 1
+            while key in result:
+                # the same name declared twice, match them up in order
+                n += 1
+                key = (d['kind'], d.get('name'), n)
+            result[key] = (fingerprint(d), d)
+        return result
+    old_keys = by_key(old)
+    new_keys = by_key(new)
+    result = OrderedDict([('added', []), ('removed', []), ('changed', [])])
+    for key, (digest, d) in new_keys.items():
+        if key not in old_keys:
+            result['added'].append({ 'kind': d['kind'], 'name': d.get('name') })
+        elif old_keys[key][0] != digest:
+            changes, abi = diff_definition(old_keys[key][1], d)
+            result['changed'].append({ 'kind': d['kind'], 'name': d.get('name'), 'abi': abi, 'changes': changes })
+    for key, (_, d) in old_keys.items():
+        if key not in new_keys:
+            result['removed'].append({ 'kind': d['kind'], 'name': d.get('name') })
+    result['abi_compatible'] = not result['removed'] and not any(c['abi'] for c in result['changed'])
+    return result
+
+def visitor_args(args, hooks=None):
+    return dict(
+        clang_path=args.clang if args.clang else None,
+        clang_args=[x.strip() for x in args.xargs] if args.xargs else [],
+        libclang_path=args.lib,
+        include_patterns=args.include_definitions if args.include_definitions else [],
+        exclude_patterns=args.exclude_definitions if args.exclude_definitions else [],
+        type_objects=args.type_objects,
+        skip_defines=args.skip_defines,
+        macro_batch_size=args.batch_defines,
+        jobs=args.jobs,
+        probe_timeout=args.probe_timeout,
+        engine="libclang" if args.watch else args.engine,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size=args.cache_size * 1024 * 1024,
+        watch=args.watch,
+        type_refs=args.type_refs,
+        stream=args.ndjson,
+        skip_bodies=args.skip_bodies,
+        evaluate_macros=not args.probe_all,
+        reachable_only=args.reachable,
+        hooks=hooks,
+        language=args.language if args.language else "c")
+
+def visitor_from_args(header, args, hooks=None):
+    return Visitor(header, **visitor_args(args, hooks))
+
+def write_timings(timings, path):
+    output = json.dumps(timings.to_dict(), indent=4)
+    if path == '-':
+        print(output, file=sys.stderr)
+    else:
+        with open(path, "w") as fh:
+            fh.write(output)
+
+def extraction(path, args):
+    """
+    The definitions in `path` for `--diff`, read back from cj output or
+    extracted from it as a header.
+    """
+    try:
+        return load_extraction(path)
+    except (ValueError, UnicodeDecodeError, KeyError, TypeError, sqlite3.Error):
+        with Visitor(path, **visitor_args(args)) as visitor:
+            return visitor.all_definitions() if visitor.type_table is None else \
+                [resolve_refs(d, visitor.type_table) for d in visitor.all_definitions()]
+
+def output_data(visitor):
+    if visitor.type_table is not None:
+        return { 'type_table': visitor.type_table, 'definitions': visitor.all_definitions() }
+    return visitor.all_definitions()
+
+def process_header(header, args):
+    """
+    Extract a single header into its own output file, for use from a process pool.
+    Returns the output path, or raises with the reason the header failed.
+    """
+    visitor = visitor_from_args(header, args)
+    if args.ndjson:
+        return write_ndjson(visitor.iter_definitions(), header, args, quiet=True)
+    visitor.release()
+    return write_output(output_data(visitor), header, args, quiet=True)
+
+def process_headers_parallel(headers, args):
+    """
+    Fan `headers` out over a pool of `args.processes` worker processes,
+    reporting each header's success or failure to stderr as it finishes.
+    Headers that don't exist fail without being submitted. Returns the number
+    of headers that failed.
+    """
+    os.makedirs(args.output, exist_ok=True)
+    failures = 0
+    for header in headers:
+        if not os.path.isfile(header):
+            failures += 1
+            print(f"FAILED: {header}: Path \"{header}\" doesn't exist", file=sys.stderr)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = { executor.submit(process_header, header, args): header for header in headers if os.path.isfile(header) }
+        for future in concurrent.futures.as_completed(futures):
+            header = futures[future]
+            try:
+                output_path = future.result()
+                print(f"OK: {header} -> {output_path}", file=sys.stderr)
+            except Exception as e:
+                failures += 1
+                print(f"FAILED: {header}: {failure_reason(e)}", file=sys.stderr)
+    return failures
+
+def failure_reason(e):
+    reason = e.args[0] if e.args and e.args[0] else type(e).__name__
+    if isinstance(reason, bytes):
+        reason = reason.decode('utf-8', 'replace')
+    return reason
+
+def load_manifest(path):
+    """
+    Read the manifest at `path`: a JSON object with a list of `headers`
+    entries and `args` given to all of them, or just the list. An entry is a
+    header path, or an object with a `header` path or list of paths and
+    optional `args` and `output`. Returns `(headers, output, argv)` for each
+    entry, `argv` being the command line arguments to run cj with.
+    """
+    with open(path) as fh:
+        manifest = json.load(fh)
+    if isinstance(manifest, list):
+        manifest = { 'headers': manifest }
+    common = manifest.get('args', [])
+    entries = []
+    for entry in manifest['headers']:
+        if isinstance(entry, str):
+            entry = { 'header': entry }
+        if 'header' not in entry:
+            raise ValueError("every entry needs a `header`")
+        headers = entry['header'] if isinstance(entry['header'], list) else [entry['header']]
+        argv = common + entry.get('args', [])
+        if not all(isinstance(a, str) for a in headers + argv):
+            raise ValueError("headers and args must be strings")
+        output = entry.get('output')
+        if output:
+            argv += ['--output', output]
+        entries.append((headers, output, argv + ['--'] + headers))
+    return entries
+
+def run_manifest(entries, args, warm=None):
+    """
+    Run each manifest entry from `load_manifest` in this process, so
+    libclang is only loaded once, with the entry's arguments on top of
+    `args`. Reports each entry's success or failure to stderr and returns
+    the number of entries that failed.
+    """
+    parser = argument_parser()
+    failures = 0
+    for headers, output, argv in entries:
+        name = ' '.join(headers)
+        base = argparse.Namespace(**vars(args))
+        base.manifest = None
+        try:
+            for header in headers:
+                if not os.path.isfile(header):
+                    raise ValueError(f"Path \"{header}\" doesn't exist")
+            entry_args = parser.parse_args(argv, namespace=base)
+            if entry_args.watch or entry_args.serve or entry_args.diff or entry_args.manifest:
+                raise ValueError("`--watch`, `--serve`, `--diff` and `--manifest` can't be used in a manifest")
+            status = main(warm=warm, args=entry_args)
+        except SystemExit as e:
+            # `parser.error` already said what was wrong
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            status = failure_reason(e)
+        if status:
+            failures += 1
+            print(f"FAILED: {name}: {status if isinstance(status, str) else f'exit status {status}'}", file=sys.stderr)
+        else:
+            print(f"OK: {name} -> {output}" if output else f"OK: {name}", file=sys.stderr)
+    return failures
+
+def output_path_for(header, args, writeover=False, quiet=False):
+    output_path = args.output
+    if output_path:
+        if os.path.exists(output_path):
+            if os.path.isfile(output_path):
+                if not (args.writeover or writeover):
+                    print(f"ERROR! File already exists at `{output_path}`, use -w/--writeover to overwrite file")
+            else:
+                parts = header.split("/")
+                folder = output_path[:-1] if output_path[-1] == '/' else output_path
+                name = ".".join(parts[-1].split(".")[:-1])
+                output_path = f"{folder}/{name}.{'ndjson' if args.ndjson else 'json'}"
+                if not quiet:
+                    print(output_path)
+                if (os.path.exists(output_path) and os.path.isfile(output_path)) and not (args.writeover or writeover):
+                    print(f"ERROR! File already exists at `{output_path}`, use -w/--writeover to overwrite file")
+    return output_path
+
+def write_output(definitions, header, args, writeover=False, quiet=False):
+    output = json.dumps(definitions,
+                        indent=None if args.minified else 4,
+                        separators=(',', ':') if args.minified else None)
+    output_path = output_path_for(header, args, writeover, quiet)
+    if output_path:
+        with open(output_path, "w") as fh:
+            fh.write(output)
+    else:
+        print(output, end='')
+    return output_path
+
+def write_ndjson(definitions, header, args, quiet=False):
+    """
+    Write one definition per line as they come, so consumers can start on
+    the output before extraction finishes.
+    """
+    output_path = output_path_for(header, args, quiet=quiet)
+    fh = open(output_path, "w") if output_path else sys.stdout
+    try:
+        for d in definitions:
+            fh.write(json.dumps(d, separators=(',', ':')))
+            fh.write('\n')
+            if not output_path:
+                fh.flush()
+    finally:
+        if output_path:
+            fh.close()
+    return output_path
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS types (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    spelling TEXT NOT NULL,
+    size INTEGER,
+    base TEXT,
+    name TEXT,
+    type_id INTEGER REFERENCES types(id),
+    function_id INTEGER REFERENCES types(id),
+    return_type_id INTEGER REFERENCES types(id),
+    array TEXT,
+    anonymous INTEGER NOT NULL DEFAULT 0,
+    variadic INTEGER NOT NULL DEFAULT 0,
+    const INTEGER NOT NULL DEFAULT 0,
+    volatile INTEGER NOT NULL DEFAULT 0,
+    restrict INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS type_arguments (
+    type_id INTEGER NOT NULL REFERENCES types(id),
+    position INTEGER NOT NULL,
+    argument_type_id INTEGER NOT NULL REFERENCES types(id),
+    PRIMARY KEY (type_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS definitions (
+    id INTEGER PRIMARY KEY,
+    header_id INTEGER NOT NULL REFERENCES headers(id),
+    position INTEGER NOT NULL,
+    source TEXT,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    spelling TEXT,
+    size INTEGER,
+    type_id INTEGER REFERENCES types(id),
+    return_type_id INTEGER REFERENCES types(id),
+    value INTEGER,
+    anonymous INTEGER NOT NULL DEFAULT 0,
+    variadic INTEGER NOT NULL DEFAULT 0,
+    json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    definition_id INTEGER NOT NULL REFERENCES definitions(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type_id INTEGER NOT NULL REFERENCES types(id),
+    PRIMARY KEY (definition_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS arguments (
+    definition_id INTEGER NOT NULL REFERENCES definitions(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type_id INTEGER NOT NULL REFERENCES types(id),
+    PRIMARY KEY (definition_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS enum_values (
+    definition_id INTEGER NOT NULL REFERENCES definitions(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (definition_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS definitions_name ON definitions(name);
+CREATE INDEX IF NOT EXISTS definitions_kind ON definitions(kind, name);
+CREATE INDEX IF NOT EXISTS definitions_header ON definitions(header_id, position);
+CREATE INDEX IF NOT EXISTS definitions_source ON definitions(source);
+CREATE INDEX IF NOT EXISTS types_spelling ON types(spelling);
+CREATE INDEX IF NOT EXISTS types_base ON types(base);
+CREATE INDEX IF NOT EXISTS fields_type ON fields(type_id);
+CREATE INDEX IF NOT EXISTS arguments_type ON arguments(type_id);
+CREATE INDEX IF NOT EXISTS enum_values_name ON enum_values(name);
+"""
+
+class SqliteOutput:
+    """
+    Writes serialized definitions into an indexed SQLite database, with a
+    table per kind of thing `to_dict` produces: definitions, the fields,
+    arguments and enum values of those, and types. Each distinct type is
+    stored once, identified by a digest of its serialized form, so the
+    same database can take any number of headers, from any number of runs.
+    Writing a header again replaces what was written for it before.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SQLITE_SCHEMA)
+        self.type_ids = dict(self.connection.execute("SELECT digest, id FROM types"))
+        self.next_type_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM types").fetchone()[0]
+        self.new_types = []
+        self.new_type_arguments = []
+
+    def close(self):
+        self.connection.close()
+
+    def type_id(self, d, memo):
+        """
+        The id of the serialized type `d`, inserting it and the types it
+        refers to when they're new. `memo` maps `id(d)` for the dicts seen
+        while writing a header, as serialized types are shared objects.
+        """
+        result = memo.get(id(d))
+        if result is not None:
+            return result
+        digest = hashlib.sha1(json.dumps(d, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+        result = self.type_ids.get(digest)
+        if result is None:
+            nested = { key: self.type_id(d[key], memo) for key in ('type', 'function', 'return_type') if key in d }
+            arguments = [self.type_id(a, memo) for a in d.get('arguments', ())]
+            result = self.type_ids[digest] = self.next_type_id
+            self.next_type_id += 1
+            self.new_types.append((
+                result, digest, d['kind'], d['spelling'], d.get('size'), d.get('base'), d.get('name'),
+                nested.get('type'), nested.get('function'), nested.get('return_type'),
+                json.dumps(d['array']) if 'array' in d else None,
+                d.get('anonymous', False), d.get('variadic', False),
+                d.get('const', False), d.get('volatile', False), d.get('restrict', False)))
+            self.new_type_arguments.extend((result, i, a) for i, a in enumerate(arguments))
+        memo[id(d)] = result
+        return result
+
+    def write(self, header, definitions, sources=None):
+        """
+        Replace the definitions of `header` with `definitions`, serialized
+        with nested type objects, in a single transaction.
+        """
+        try:
+            self.write_rows(header, definitions, sources)
+        except:
+            # forget the types that were rolled back along with the rest
+            self.type_ids = dict(self.connection.execute("SELECT digest, id FROM types"))
+            self.next_type_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM types").fetchone()[0]
+            raise
+        finally:
+            self.new_types = []
+            self.new_type_arguments = []
+
+    def write_rows(self, header, definitions, sources):
+        memo = {}
+        definition_rows = []
+        field_rows = []
+        argument_rows = []
+        value_rows = []
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR IGNORE INTO headers (path) VALUES (?)", (header,))
+            header_id = cursor.execute("SELECT id FROM headers WHERE path = ?", (header,)).fetchone()[0]
+            for table in ('fields', 'arguments', 'enum_values'):
+                cursor.execute(f"DELETE FROM {table} WHERE definition_id IN (SELECT id FROM definitions WHERE header_id = ?)", (header_id,))
+            cursor.execute("DELETE FROM definitions WHERE header_id = ?", (header_id,))
+            next_id = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM definitions").fetchone()[0]
+            for position, d in enumerate(definitions):
+                definition_id = next_id + position
+                type_id = self.type_id(d['type'], memo) if 'type' in d else None
+                return_type_id = self.type_id(d['return_type'], memo) if 'return_type' in d else None
+                definition_rows.append((
+                    definition_id, header_id, position, sources[position] if sources else None,
+                    d['kind'], d['name'], d.get('spelling'), d.get('size'), type_id, return_type_id,
+                    d.get('value'), d.get('anonymous', False), d.get('variadic', False),
+                    json.dumps(d, separators=(',', ':'))))
+                for i, f in enumerate(d.get('fields', ())):
+                    field_rows.append((definition_id, i, f['name'], self.type_id(f['type'], memo)))
+                if d['kind'] == 'function':
+                    for i, a in enumerate(d['arguments']):
+                        argument_rows.append((definition_id, i, a['name'], self.type_id(a['type'], memo)))
+                for i, v in enumerate(d.get('values', ())):
+                    value_rows.append((definition_id, i, v['name'], v['value']))
+            cursor.executemany("INSERT INTO types VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.new_types)
+            cursor.executemany("INSERT INTO type_arguments VALUES (?, ?, ?)", self.new_type_arguments)
+            cursor.executemany("INSERT INTO definitions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", definition_rows)
+            cursor.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)", field_rows)
+            cursor.executemany("INSERT INTO arguments VALUES (?, ?, ?, ?)", argument_rows)
+            cursor.executemany("INSERT INTO enum_values VALUES (?, ?, ?, ?)", value_rows)
+
+class ShardedOutput:
+    """
+    Writes the definitions of each header into a directory, one JSON shard
+    per source file they come from, plus a `manifest.json` recording each
+    shard's file, content hash and the types it uses that are declared in
+    other shards. Shards whose content hash didn't change aren't rewritten,
+    so consumers can reload only the shards that did.
+
+    Shards belong to one header extracted with one set of `options`, so a
+    file several headers include gets a shard for each of them, and headers
+    extracted with different options into the same directory don't
+    overwrite each other.
+    """
+    MANIFEST = 'manifest.json'
+    BUILTIN = '<built-in>'
+    # the `Visitor` arguments that change what's extracted
+    OPTIONS = ('clang_args', 'include_patterns', 'exclude_patterns', 'type_objects', 'skip_defines',
+               'evaluate_macros', 'reachable_only', 'language')
+
+    def __init__(self, directory, minified=False, options={}):
+        self.directory = directory
+        self.minified = minified
+        self.options = { name: options.get(name) for name in self.OPTIONS }
+        self.variant = hashlib.sha1(json.dumps(self.options, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.MANIFEST)) as fh:
+                self.manifest = json.load(fh)
+        except (OSError, ValueError):
+            self.manifest = { 'headers': {} }
+        if 'shards' in self.manifest:
+            # written before shards were kept per header, start over
+            self.manifest = { 'headers': {} }
+
+    def shard_file(self, header, source):
+        name = re.sub(r'[^\w.-]', '_', os.path.basename(source))
+        key = '\0'.join((header, self.variant, source))
+        return f"{name}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}.json"
+
+    def write_file(self, name, data):
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, os.path.join(self.directory, name))
+
+    def write(self, header, definitions, sources):
+        """
+        Split the definitions of `header` into shards by their `sources`,
+        write the shards that changed and update the manifest. Returns the
+        paths of the shards written.
+        """
+        shards = OrderedDict()
+        for d, source in zip(definitions, sources):
+            shards.setdefault(source or self.BUILTIN, []).append(d)
+        declared = { d['spelling']: source for source, ds in shards.items() for d in ds
+                     if d['kind'] in TYPE_DEFINITION_KINDS }
+        variants = self.manifest['headers'].setdefault(header, {})
+        previous = variants.get(self.variant, {}).get('shards', {})
+        entry = { 'options': self.options, 'shards': OrderedDict() }
+        written = []
+        for source, ds in shards.items():
+            references = {}
+            for ref in type_references(ds):
+                other = declared.get(ref)
+                if other is not None and other != source:
+                    references.setdefault(other, set()).add(ref)
+            data = json.dumps(ds,
+                              indent=None if self.minified else 4,
+                              separators=(',', ':') if self.minified else None)
+            digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+            name = self.shard_file(header, source)
+            shard = previous.get(source)
+            if shard is None or shard['hash'] != digest or not os.path.exists(os.path.join(self.directory, name)):
+                self.write_file(name, data)
+                written.append(os.path.join(self.directory, name))
+            entry['shards'][source] = {
+                'file': name,
+                'hash': digest,
+                'definitions': len(ds),
+                'references': { other: sorted(refs) for other, refs in sorted(references.items()) },
+            }
+
+        variants[self.variant] = entry
+        for source, shard in previous.items():
+            if source not in entry['shards']:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(self.directory, shard['file']))
+        self.write_file(self.MANIFEST, json.dumps(self.manifest, indent=4))
+        return written
+
+def warm_visitor(header, args, hooks, warm):
+    """
+    Get a visitor for `header` from `warm`, the visitors a server worker
+    kept from earlier requests with the same arguments, updating it if
+    anything it includes changed. New visitors are made with `watch=True` so
+    they can be updated later, and only the `args.warm_headers` most recently
+    used are kept. They always parse with the libclang engine, which gives the
+    same output as the clang one.
+    """
+    kwargs = visitor_args(args)
+    kwargs.update(engine="libclang", watch=True)
+    key = (os.getcwd(), os.path.abspath(header), tuple(os.environ.get(name) for name in SERVER_ENV),
+           json.dumps(kwargs, sort_keys=True))
+    kwargs['hooks'] = hooks
+    visitor = warm.pop(key, None)
+    if visitor is not None:
+        visitor.hooks = hooks
+        if visitor.stale() and not visitor.update():
+            visitor.release()
+            raise CompilationError(b"")
+    else:
+        try:
+            visitor = Visitor(header, **kwargs)
+        except ValueError:
+            # `--clang` doesn't match the loaded libclang, so it can't be kept warm
+            return visitor_from_args(header, args, hooks)
+    warm[key] = visitor
+    while len(warm) > args.warm_headers:
+        warm.popitem(last=False)[1].release()
+    return visitor
+
+WORKER_VISITORS = OrderedDict()
+
+def init_worker(libclang_path):
+    # the server process handles interrupts and shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if libclang_path:
+        load_libclang(libclang_path)
+    clang.Index.create()
+
+def serve_request(request):
+    """
+    Run `main` in a server worker with the arguments, working directory and
+    environment of a `cj-client` request. Returns the exit status and what
+    was written to stdout and stderr.
+    """
+    os.chdir(request['cwd'])
+    for name in SERVER_ENV:
+        if name in request['env']:
+            os.environ[name] = request['env'][name]
+        else:
+            os.environ.pop(name, None)
+    stdout = io.StringIO()
+    with tempfile.TemporaryFile() as stderr:
+        # clang writes its diagnostics to the stderr file descriptor itself
+        sys.stderr.flush()
+        saved_stderr = os.dup(2)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            with contextlib.redirect_stdout(stdout):
+                status = main(request['argv'], WORKER_VISITORS)
+        except SystemExit as e:
+            status = e.code or 0
+            if not isinstance(status, int):
+                print(status, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stderr.flush()
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stderr)
+        stderr.seek(0)
+        return status, stdout.getvalue(), stderr.read().decode('utf-8', 'replace')
+
+def serve(socket_path, args):
+    """
+    Serve `cj-client` requests on the Unix socket `socket_path` until
+    interrupted. A request is a line of JSON with the client's `argv`, `cwd`
+    and `env`, answered with a line of JSON with its `status`, `stdout` and
+    `stderr`. Requests are handled by `args.workers` worker processes with
+    libclang loaded, and the same arguments always go to the same worker,
+    so the headers it parsed last time are still warm.
+    """
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                # left behind by a server that didn't shut down cleanly
+                os.unlink(socket_path)
+            else:
+                print(f"ERROR! A server is already running on `{socket_path}`", file=sys.stderr)
+                return 1
+
+    def start_worker():
+        worker = concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(args.lib,))
+        worker.submit(int).result()
+        return worker
+    workers = [start_worker() for _ in range(max(1, args.workers))]
+    workers_lock = threading.Lock()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                key = json.dumps([request['cwd'], request['argv']]).encode('utf-8')
+                n = int(hashlib.sha256(key).hexdigest(), 16) % len(workers)
+                try:
+                    status, stdout, stderr = workers[n].submit(serve_request, request).result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    with workers_lock:
+                        workers[n].shutdown(wait=False)
+                        workers[n] = start_worker()
+                    raise
+            except Exception as e:
+                status, stdout, stderr = 1, "", f"ERROR! {type(e).__name__}: {e}\n"
+            self.wfile.write(json.dumps({ 'status': status, 'stdout': stdout, 'stderr': stderr }).encode('utf-8') + b'\n')
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server = Server(socket_path, RequestHandler)
+    os.chmod(socket_path, 0o600)
+    print(f"Serving on `{socket_path}` with {len(workers)} workers", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        for worker in workers:
+            worker.shutdown(cancel_futures=True)
+    return 0
+
+def argument_parser():
     parser = argparse.ArgumentParser(description="Serialise C headers to Lua C bindings w/ python + libclang!")
-    parser.add_argument("headers", metavar="HEADERS", type=str, nargs="+",
+    parser.add_argument("headers", metavar="HEADERS", type=str, nargs="*",
                         help="Path to header file(s) to process")
     parser.add_argument("-c", "--clang", metavar="PATH", type=str,
                         help="Specify the path to `clang`")
@@ -601,47 +2956,182 @@ if __name__ == '__main__':
                         help="If the output destination exists, overwrite it.")
     parser.add_argument("-s", "--skip-defines", action="store_true",
                         help="By default, cj will try compiling object-like macros looking for constants, which may take long if your header has lots of them. Use this flag to skip this step")
+    parser.add_argument("-b", "--batch-defines", metavar="SIZE", type=int, nargs="?", const=256, default=0,
+                        help="Probe object-like macros in batches of SIZE (default: 256) per clang invocation instead of one invocation per macro")
+    parser.add_argument("--probe-all", action="store_true",
+                        help="Probe every macro with clang, instead of first evaluating simple constant expressions in Python")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="Run up to N clang macro probes concurrently (default: 1)")
+    parser.add_argument("--probe-timeout", metavar="SECONDS", type=float,
+                        help="Give up on a macro probe after SECONDS, with either engine")
+    parser.add_argument("-e", "--engine", choices=["clang", "libclang"], default="clang",
+                        help="Run clang as a subprocess per translation unit (`clang`, default) or parse in-process with the loaded libclang (`libclang`). Falls back to `clang` when `--clang` doesn't match the loaded libclang")
+    parser.add_argument("--skip-bodies", action="store_true",
+                        help="Don't parse function bodies, which only declarations are extracted from (`--engine libclang` only)")
+    parser.add_argument("--cache-dir", metavar="PATH", type=str,
+                        help="Cache extracted definitions and the precompiled headers macros are probed with in PATH, keyed on the contents of the header and everything it includes, cj itself, the clang in use and the environment variables clang finds includes with. Nothing is cached without it")
+    parser.add_argument("--cache-size", metavar="MB", type=int, default=256,
+                        help="Evict least recently used cache entries once the cache grows past MB megabytes (default: 256)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't read or write the cache, even with `--cache-dir`")
+    parser.add_argument("-W", "--watch", action="store_true",
+                        help="Keep running and rewrite the output whenever the header or anything it includes changes, only redoing definitions from changed files (implies `--engine libclang`)")
+    parser.add_argument("--watch-interval", metavar="SECONDS", type=float, default=0.5,
+                        help="How often to check for changes with `--watch` (default: 0.5)")
+    parser.add_argument("-p", "--processes", metavar="N", type=int, default=1,
+                        help="Process up to N headers at once in separate processes, writing each to its own file in the `--output` directory and reporting per-header success or failure (default: 1)")
+    parser.add_argument("-U", "--umbrella", action="store_true",
+                        help="Parse all headers as one translation unit and output a single object with a shared `types` table and the remaining definitions of each header under `headers`")
+    parser.add_argument("-r", "--type-refs", action="store_true",
+                        help="Serialize each type once into a `type_table` and refer to it elsewhere as `{\"$ref\": id}`, outputting an object with `type_table` and `definitions`")
+    parser.add_argument("-n", "--ndjson", action="store_true",
+                        help="Stream definitions as newline delimited JSON, one definition per line, while the header is being traversed")
     parser.add_argument("-t", "--type-objects", action="store_true",
                         help="Output type objects instead of simply the type spelling string")
     parser.add_argument("-m", "--minified", action="store_true",
                         help="Output minified JSON instead of using 0 space indentations")
     parser.add_argument("-x", "--language", action="store_true",
                         help="Set `-x {lang}` when running clang")
-    args = parser.parse_args()
-
+    parser.add_argument("--reachable", action="store_true",
+                        help="Only output the struct, union, enum and typedef declarations used by the functions, variables and constants being output")
+    parser.add_argument("--timings", metavar="PATH", type=str, nargs="?", const="-",
+                        help="Write the wall time and calls of each phase, clang invocations, macro probes and type cache hits as JSON to PATH, or stderr if no PATH is given")
+    parser.add_argument("--profile", metavar="PATH", type=str,
+                        help="Profile the run with cProfile and dump the stats to PATH")
+    parser.add_argument("--sqlite", metavar="PATH", type=str,
+                        help="Write the definitions of every header into the indexed SQLite database at PATH instead of outputting JSON, replacing any earlier definitions of the same headers")
+    parser.add_argument("--shards", metavar="DIR", type=str,
+                        help="Write the definitions into directory DIR split into one JSON file per source file they come from, with a `manifest.json` recording each file's content hash and the types it uses from the others, only rewriting the files that changed")
+    parser.add_argument("--diff", metavar=("OLD", "NEW"), type=str, nargs=2,
+                        help="Compare two extractions, each either cj output (JSON, NDJSON or `--sqlite`) or a header to extract with the other options, and output what was added, removed or changed, exiting with 1 if anything did")
+    parser.add_argument("--serve", metavar="SOCKET", type=str, nargs="?", const=default_socket_path(),
+                        help="Run as a server for `cj-client` on the Unix socket SOCKET (default: `$TMPDIR/cj-$UID.sock`), keeping libclang loaded and recently parsed headers warm between requests")
+    parser.add_argument("--workers", metavar="N", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes handling requests with `--serve` (default: number of CPUs)")
+    parser.add_argument("--warm-headers", metavar="N", type=int, default=16,
+                        help="Number of parsed headers each `--serve` worker keeps to reuse between requests (default: 16)")
+    parser.add_argument("--manifest", metavar="PATH", type=str,
+                        help="Process the headers listed in the JSON manifest at PATH, each with its own arguments, filters and output, in this one process, on top of the other options given")
+    return parser
+
+def main(argv=None, warm=None, args=None):
+    """
+    Run cj with the command line arguments `argv`, or the already parsed
+    `args`, returning the exit status. `warm` is given by server workers,
+    holding visitors to reuse across calls.
+    """
+    parser = argument_parser()
+    if args is None:
+        args = parser.parse_args(argv)
+    if args.serve:
+        if warm is not None:
+            parser.error("`--serve` can't be requested from a server")
+        return serve(args.serve, args)
+    if args.diff:
+        report = diff(*(extraction(path, args) for path in args.diff))
+        write_output(report, "diff.h", args)
+        return 0 if not (report['added'] or report['removed'] or report['changed']) else 1
+    if args.manifest:
+        if args.headers or args.watch:
+            parser.error("`--manifest` can't be used with HEADERS or `--watch`")
+        try:
+            entries = load_manifest(args.manifest)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error(f"can't read manifest `{args.manifest}`: {e}")
+        return 1 if run_manifest(entries, args, warm) else 0
+    if not args.headers:
+        parser.error("the following arguments are required: HEADERS")
+    if warm is not None and args.watch:
+        parser.error("`--watch` can't be requested from a server")
+    if args.ndjson and (args.umbrella or args.watch or args.type_refs or args.reachable):
+        parser.error("`--ndjson` can't be used with `--umbrella`, `--watch`, `--type-refs` or `--reachable`")
+    if args.sqlite and (args.ndjson or args.umbrella or args.type_refs or args.processes > 1):
+        parser.error("`--sqlite` can't be used with `--ndjson`, `--umbrella`, `--type-refs` or `--processes`")
+    if args.shards and (args.output or args.sqlite or args.ndjson or args.umbrella or args.type_refs or args.processes > 1):
+        parser.error("`--shards` can't be used with `--output`, `--sqlite`, `--ndjson`, `--umbrella`, `--type-refs` or `--processes`")
+    if args.umbrella and (args.watch or args.processes > 1):
+        parser.error("`--umbrella` can't be used with `--watch` or `--processes`")
+    if args.processes > 1:
+        if args.watch:
+            parser.error("`--processes` can't be used with `--watch`")
+        if not args.output or os.path.isfile(args.output):
+            parser.error("`--processes` needs `--output` to be a directory")
+        if args.timings or args.profile:
+            parser.error("`--timings` and `--profile` can't be used with `--processes`")
+
+    if args.processes > 1:
+        # missing headers are reported and counted as failures with the rest
+        return 1 if process_headers_parallel([h for h in args.headers if h], args) else 0
+
+    headers = []
     for header in args.headers:
         if not header:
             continue
         if not os.path.exists(header) or not os.path.isfile(header):
             print(f"ERROR! Path \"{header}\" doesn't exist")
             continue
-        visitor = Visitor(header,
-            clang_path=args.clang if args.clang else None,
-            clang_args=[x.strip() for x in args.xargs] if args.xargs else [],
-            libclang_path=args.lib,
-            include_patterns=args.include_definitions if args.include_definitions else [],
-            exclude_patterns=args.exclude_definitions if args.exclude_definitions else [],
-            type_objects=args.type_objects,
-            skip_defines=args.skip_defines,
-            language=args.language if args.language else "c")
+        headers.append(header)
+
+    timings = Timings() if args.timings else None
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+
+    if warm is None:
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-        json = json.dumps(visitor.all_definitions(),
-                            indent=None if args.minified else 4,
-                            separators=(',', ':') if args.minified else None)
-        if args.output:
-            if os.path.exists(args.output):
-                if os.path.isfile(args.output):
-                    if not args.writeover:
-                        print(f"ERROR! File already exists at `{args.output}`, use -w/--writeover to overwrite file")
-                else:
-                    parts = header.split("/")
-                    folder = args.output[:-1] if args.output[-1] == '/' else args.output
-                    name = ".".join(parts[-1].split(".")[:-1])
-                    args.output = f"{folder}/{name}.json"
-                    print(args.output)
-                    if (os.path.exists(args.output) and os.path.isfile(args.output)) and not args.writeover:
-                        print(f"ERROR! File already exists at `{args.output}`, use -w/--writeover to overwrite file")
-            with open(args.output, "w") as fh:
-                fh.write(json)
-        else:
-            print(json, end='')
+    sqlite = SqliteOutput(args.sqlite) if args.sqlite else None
+    shards = ShardedOutput(args.shards, args.minified, visitor_args(args)) if args.shards else None
+    def output(visitor, header, writeover=False):
+        with visitor.phase('output'):
+            if sqlite:
+                sqlite.write(header, visitor.all_definitions(), visitor.sources)
+            elif shards:
+                for path in shards.write(header, visitor.all_definitions(), visitor.sources):
+                    print(path)
+            else:
+                write_output(output_data(visitor), header, args, writeover=writeover)
+
+    if args.umbrella:
+        write_output(umbrella(headers, **visitor_args(args, timings)), "umbrella.h", args)
+    else:
+        visitors = []
+        for header in headers:
+            if warm is not None and not (args.ndjson or args.type_refs):
+                visitor = warm_visitor(header, args, timings, warm)
+            else:
+                visitor = visitor_from_args(header, args, timings)
+            if args.ndjson:
+                write_ndjson(visitor.iter_definitions(), header, args)
+            else:
+                output(visitor, header)
+            if args.watch:
+                visitors.append((header, visitor))
+            elif not visitor.watch:
+                visitor.release()
+
+        if args.watch:
+            if timings:
+                write_timings(timings, args.timings)
+            try:
+                while True:
+                    time.sleep(args.watch_interval)
+                    for header, visitor in visitors:
+                        if visitor.update():
+                            # rewriting our own output
+                            output(visitor, header, writeover=True)
+                            if timings:
+                                write_timings(timings, args.timings)
+            except KeyboardInterrupt:
+                pass
+
+    if sqlite:
+        sqlite.close()
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    if timings and not args.watch:
+        write_timings(timings, args.timings)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
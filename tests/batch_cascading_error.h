@@ -0,0 +1,18 @@
+/*
+ * A macro that breaks the line after its probe must not take the next
+ * constant down with it when probing in batches (`-b`).
+ * Expected constants: G1, G2, G3, G4, G5. Not LB.
+ */
+#ifndef BATCH_CASCADING_ERROR_H
+#define BATCH_CASCADING_ERROR_H
+
+#define G1 1
+#define G2 2
+#define G3 3
+#define G4 4
+#define LB {
+#define G5 5
+
+int batch_cascading_error(void);
+
+#endif
@@ -0,0 +1,41 @@
+import os, sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+# `const auto` macro probes need C23
+CLANG_ARGS = ['-std=c2x']
+
+
+@pytest.fixture
+def headers(tmp_path, monkeypatch):
+    """
+    Write `{path: source}` into a temporary working directory, wrapping each
+    header in an include guard.
+    """
+    monkeypatch.chdir(tmp_path)
+    def write(files):
+        for path, source in files.items():
+            guard = path.upper().replace('.', '_').replace('/', '_')
+            (tmp_path / path).write_text(f"#ifndef {guard}\n#define {guard}\n{source}#endif\n")
+    return write
+
+
+def edit(path, old, new):
+    """
+    Replace `old` with `new` in `path`, moving its mtime forward so watching
+    visitors see the change even on coarse clocks.
+    """
+    with open(path) as f:
+        source = f.read()
+    assert old in source
+    with open(path, 'w') as f:
+        f.write(source.replace(old, new))
+    mtime = os.stat(path).st_mtime_ns + 1_000_000_000
+    os.utime(path, ns=(mtime, mtime))
+
+
+def constants(definitions):
+    return {d['name']: d.get('type', {}).get('spelling') for d in definitions if d['kind'] == 'const'}
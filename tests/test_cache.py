@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import cj
+from conftest import CLANG_ARGS, edit
+
+FILES = {
+    'inc.h': 'typedef int inc_t;\n',
+    'c.h': '#include "inc.h"\ninc_t c_fn(void);\n#define C 1\n',
+    'd.h': 'int d_fn(void);\n',
+}
+
+
+def extract(header, cache_dir='cache', **kwargs):
+    """
+    The definitions of `header` and whether they came from the cache.
+    """
+    timings = cj.Timings()
+    definitions = cj.defs(header, clang_args=CLANG_ARGS, engine='libclang', cache_dir=cache_dir, hooks=timings, **kwargs)
+    hits, misses = timings.counters.get('cache_hits', 0), timings.counters.get('cache_misses', 0)
+    assert hits + misses == (1 if cache_dir else 0)
+    return definitions, hits == 1
+
+
+def test_nothing_is_cached_without_a_cache_dir(headers, tmp_path):
+    headers(FILES)
+    extract('c.h', cache_dir=None)
+    assert not (tmp_path / 'cache').exists()
+
+
+@pytest.mark.parametrize('path, old, new', [
+    ('c.h', '#define C 1', '#define C 1.0'),
+    ('inc.h', 'typedef int inc_t', 'typedef long inc_t'),
+])
+def test_edits_invalidate(headers, path, old, new):
+    headers(FILES)
+    first, hit = extract('c.h')
+    assert not hit
+    assert extract('c.h') == (first, True)
+    edit(path, old, new)
+    definitions, hit = extract('c.h')
+    assert not hit and definitions != first
+    assert definitions == cj.defs('c.h', clang_args=CLANG_ARGS, engine='libclang')
+    assert extract('c.h') == (definitions, True)
+
+
+def test_options_and_environment_are_part_of_the_key(headers, monkeypatch, tmp_path):
+    headers(FILES)
+    extract('c.h')
+    assert not extract('c.h', skip_defines=True)[1]
+    assert not extract('d.h')[1]
+    assert extract('c.h')[1]
+    monkeypatch.setenv('CPATH', str(tmp_path))
+    assert not extract('c.h')[1]
+
+
+def test_cache_size_evicts(headers, tmp_path):
+    headers(FILES)
+    extract('c.h', cache_size=1)
+    extract('d.h', cache_size=1)
+    assert len(os.listdir(tmp_path / 'cache')) <= 1
+    assert not extract('c.h', cache_size=1)[1]
+
+
+def test_umbrella_is_cached(headers, monkeypatch):
+    headers(FILES)
+    kwargs = dict(clang_args=CLANG_ARGS, engine='libclang', cache_dir='cache')
+    first = cj.umbrella(['c.h', 'd.h'], **kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(cj, 'Visitor', None)
+        assert cj.umbrella(['c.h', 'd.h'], **kwargs) == first
+    edit('inc.h', 'typedef int inc_t', 'typedef long inc_t')
+    assert cj.umbrella(['c.h', 'd.h'], **kwargs) == cj.umbrella(['c.h', 'd.h'], clang_args=CLANG_ARGS, engine='libclang')
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import cj
+from conftest import CLANG_ARGS, TESTS_DIR, constants
+
+FILES = {
+    'm.h': 'enum { E = 4 };\ntypedef unsigned short half_t;\nint m_fn(void);\n'
+           '#define INT 1\n#define NEG (-2)\n#define BIG 0x100000000\n#define FLT 1.5f\n#define DBL (INT / 3.0)\n'
+           '#define STR "str"\n#define CHR \'c\'\n#define SUM (INT + E)\n#define CAST ((half_t)7)\n'
+           '#define SIZE sizeof(half_t)\n#define CALL(x) (x)\n#define EMPTY\n#define BROKEN {\n'
+           '#define AFTER 8\n#define UNKNOWN not_declared\n#define LAST (AFTER << 1)\n',
+}
+
+EXPECTED = {
+    'E': None, 'INT': 'const int', 'NEG': 'const int', 'BIG': 'const long', 'FLT': 'const float',
+    'DBL': 'const double', 'STR': 'char *const', 'CHR': 'const int', 'SUM': 'const int',
+    'CAST': 'const unsigned short', 'SIZE': 'const unsigned long', 'AFTER': 'const int', 'LAST': 'const int',
+}
+
+
+def extract(header, **kwargs):
+    return constants(cj.defs(header, clang_args=CLANG_ARGS, engine='libclang', **kwargs))
+
+
+@pytest.mark.parametrize('evaluate_macros', [True, False], ids=['evaluate', 'probe-all'])
+@pytest.mark.parametrize('jobs', [1, 4])
+@pytest.mark.parametrize('macro_batch_size', [0, 4, 64])
+def test_constants_dont_depend_on_how_they_are_probed(headers, macro_batch_size, jobs, evaluate_macros):
+    headers(FILES)
+    assert extract('m.h', macro_batch_size=macro_batch_size, jobs=jobs, evaluate_macros=evaluate_macros) == EXPECTED
+
+
+@pytest.mark.parametrize('evaluate_macros', [True, False], ids=['evaluate', 'probe-all'])
+@pytest.mark.parametrize('macro_batch_size', [0, 4, 256])
+@pytest.mark.parametrize('header, expected', [
+    ('batch_cascading_error.h', ['G1', 'G2', 'G3', 'G4', 'G5']),
+    ('undef_dead_branch.h', ['KEPT', 'REDEFINED']),
+])
+def test_example_headers(header, expected, macro_batch_size, evaluate_macros):
+    found = extract(os.path.join(TESTS_DIR, header), macro_batch_size=macro_batch_size, evaluate_macros=evaluate_macros)
+    assert list(found) == expected
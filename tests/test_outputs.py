@@ -0,0 +1,120 @@
+import json, os, sqlite3
+
+import pytest
+
+import cj
+from conftest import CLANG_ARGS, edit
+
+FILES = {
+    'types.h': 'typedef unsigned long size;\nstruct node { struct node *next; size n; };\n'
+               'enum color { RED, GREEN = 4 };\n',
+    'a.h': '#include "types.h"\nstruct node *a_push(struct node *head, size n);\n'
+           'typedef int (*a_cb)(const char *name, ...);\nextern enum color a_color;\n#define A_MAX 16\n',
+    'b.h': '#include "types.h"\nunion b_u { int i; float f; char c[4]; };\nvoid b_each(a_cb cb);\n',
+}
+FILES['b.h'] = '#include "a.h"\n' + FILES['b.h']
+
+
+def run(*argv):
+    return cj.main([*argv, '-e', 'libclang', '--xargs', *(' ' + arg for arg in CLANG_ARGS)])
+
+
+def plain(header):
+    return cj.defs(header, clang_args=CLANG_ARGS, engine='libclang')
+
+
+def unordered(definitions):
+    return sorted(map(cj.fingerprint, definitions))
+
+
+@pytest.mark.parametrize('header', ['a.h', 'b.h'])
+def test_type_refs_resolve_to_plain_output(headers, header):
+    headers(FILES)
+    with cj.Visitor(header, clang_args=CLANG_ARGS, engine='libclang', type_refs=True) as visitor:
+        definitions = visitor.all_definitions()
+        table = visitor.type_table
+    assert any('$ref' in json.dumps(d) for d in definitions)
+    assert [cj.resolve_refs(d, table) for d in definitions] == plain(header)
+
+
+@pytest.mark.parametrize('flags', [[], ['--type-refs'], ['--ndjson'], ['--minified']])
+def test_outputs_read_back(headers, flags):
+    headers(FILES)
+    assert run(*flags, '-o', 'out.json', 'b.h') == 0
+    if '--ndjson' in flags:
+        assert unordered(cj.load_extraction('out.json')) == unordered(plain('b.h'))
+    else:
+        assert cj.load_extraction('out.json') == plain('b.h')
+
+
+def test_ndjson_streams_plain_output(headers):
+    headers(FILES)
+    streamed = list(cj.Visitor('b.h', clang_args=CLANG_ARGS, engine='libclang', stream=True).iter_definitions())
+    assert unordered(streamed) == unordered(plain('b.h'))
+
+
+def test_umbrella_splits_headers(headers):
+    headers(FILES)
+    result = cj.umbrella(['a.h', 'b.h'], clang_args=CLANG_ARGS, engine='libclang')
+    assert list(result['headers']) == ['a.h', 'b.h']
+    together = result['types'] + [d for ds in result['headers'].values() for d in ds]
+    assert unordered(together) == unordered(plain('b.h'))
+    assert [d['name'] for d in result['headers']['b.h']] == ['b_each']
+    assert run('--umbrella', '-o', 'umbrella.json', 'a.h', 'b.h') == 0
+    assert cj.load_extraction('umbrella.json') == together
+
+
+def test_umbrella_type_refs(headers):
+    headers(FILES)
+    plain_result = cj.umbrella(['a.h', 'b.h'], clang_args=CLANG_ARGS, engine='libclang')
+    result = cj.umbrella(['a.h', 'b.h'], clang_args=CLANG_ARGS, engine='libclang', type_refs=True)
+    assert [cj.resolve_refs(d, result['type_table']) for d in result['types']] == plain_result['types']
+    for header, definitions in result['headers'].items():
+        assert [cj.resolve_refs(d, result['type_table']) for d in definitions] == plain_result['headers'][header]
+
+
+def test_sqlite(headers):
+    headers(FILES)
+    assert run('--sqlite', 'out.db', 'a.h', 'b.h') == 0
+    assert run('--sqlite', 'out.db', 'b.h') == 0
+    with sqlite3.connect('out.db') as connection:
+        rows = connection.execute("SELECT h.path, d.json FROM definitions d JOIN headers h ON h.id = d.header_id "
+                                  "ORDER BY h.id, d.position").fetchall()
+        assert connection.execute("SELECT COUNT(*) FROM types").fetchone()[0] == \
+            connection.execute("SELECT COUNT(DISTINCT digest) FROM types").fetchone()[0]
+        values = connection.execute("SELECT v.name, v.value FROM enum_values v JOIN definitions d "
+                                    "ON d.id = v.definition_id WHERE d.header_id = 1 ORDER BY v.position").fetchall()
+    for header in ('a.h', 'b.h'):
+        assert [json.loads(d) for h, d in rows if h == header] == plain(header)
+    assert values == [('RED', 0), ('GREEN', 4)]
+    assert cj.load_extraction('out.db') == plain('a.h') + plain('b.h')
+
+
+def test_diff(headers, capsys):
+    headers(FILES)
+    assert run('-o', 'old.json', 'a.h') == 0
+    assert run('--diff', 'old.json', 'a.h') == 0
+    assert json.loads(capsys.readouterr().out)['abi_compatible']
+    edit('types.h', 'enum color { RED, GREEN = 4 };', 'enum color { RED, GREEN = 5 };')
+    edit('a.h', 'extern enum color a_color;', 'extern enum color a_color;\nint a_new(void);')
+    edit('a.h', '#define A_MAX 16\n', '')
+    assert run('--diff', 'old.json', 'a.h') == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report['added'] == [{ 'kind': 'function', 'name': 'a_new' }]
+    assert report['removed'] == [{ 'kind': 'const', 'name': 'A_MAX' }]
+    assert [(c['kind'], c['name'], c['abi']) for c in report['changed']] == [('enum', 'color', True)]
+    assert not report['abi_compatible']
+
+
+def test_processes_report_failures(headers, capsys):
+    headers(dict(FILES, **{ 'broken.h': 'struct broken { int x\n' }))
+    assert run('-p', '2', '-o', 'out', 'a.h', 'missing.h', 'broken.h', 'b.h') == 1
+    # the reasons of compilation failures go on with clang's diagnostics
+    report = sorted(line for line in capsys.readouterr().err.splitlines() if line.startswith(('OK: ', 'FAILED: ')))
+    assert report[0].startswith('FAILED: broken.h: ') and 'error:' in report[0]
+    assert report[1:] == ['FAILED: missing.h: Path "missing.h" doesn\'t exist',
+                          'OK: a.h -> out/a.json', 'OK: b.h -> out/b.json']
+    for header in ('a.h', 'b.h'):
+        with open(os.path.join('out', os.path.splitext(header)[0] + '.json')) as f:
+            assert json.load(f) == plain(header)
+    assert run('-p', '2', '-o', 'out', 'a.h', 'b.h') == 0
@@ -0,0 +1,31 @@
+import pytest
+
+import cj
+from conftest import CLANG_ARGS, edit
+
+FILES = {
+    'r.h': 'struct hidden { int h; };\nstruct unused { int u; };\n'
+           'typedef struct { struct hidden *h; } wrap_t;\nvoid use(wrap_t *w);\n',
+}
+
+
+def names(definitions):
+    return [(d['kind'], d['name']) for d in definitions]
+
+
+@pytest.mark.parametrize('type_refs', [False, True], ids=['inline', 'type-refs'])
+def test_reachable_follows_declarations_sharing_a_spelling(headers, type_refs):
+    headers(FILES)
+    with cj.Visitor('r.h', clang_args=CLANG_ARGS, engine='libclang', reachable_only=True, type_refs=type_refs) as visitor:
+        assert names(visitor.all_definitions()) == [
+            ('struct', 'hidden'), ('struct', 'wrap_t'), ('typedef', 'wrap_t'), ('function', 'use')]
+
+
+def test_reachable_watch_update(headers):
+    headers(FILES)
+    visitor = cj.Visitor('r.h', clang_args=CLANG_ARGS, engine='libclang', reachable_only=True, watch=True)
+    assert ('struct', 'hidden') in names(visitor.all_definitions())
+    edit('r.h', 'void use(wrap_t *w);', 'void use(struct unused *u);')
+    assert visitor.update()
+    assert names(visitor.all_definitions()) == [('struct', 'unused'), ('function', 'use')]
+    assert visitor.all_definitions() == cj.defs('r.h', clang_args=CLANG_ARGS, engine='libclang', reachable_only=True)
@@ -0,0 +1,79 @@
+import hashlib, json, os
+
+import cj
+from conftest import CLANG_ARGS
+
+FILES = {
+    'types.h': 'typedef int t_int;\nstruct common { int c; };\n',
+    'a.h': '#include "types.h"\nint a_fn(t_int x);\n',
+    'b.h': '#include "types.h"\nint b_fn(struct common *c);\n',
+}
+
+
+def write_shards(directory, headers, clang_args=CLANG_ARGS):
+    shards = cj.ShardedOutput(directory, options={ 'clang_args': clang_args })
+    written = []
+    for header in headers:
+        with cj.Visitor(header, clang_args=clang_args, engine='libclang') as visitor:
+            written.extend(shards.write(header, visitor.all_definitions(), visitor.sources))
+    return written
+
+
+def check_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for variants in manifest['headers'].values():
+        for entry in variants.values():
+            for shard in entry['shards'].values():
+                with open(os.path.join(directory, shard['file'])) as f:
+                    data = f.read()
+                assert hashlib.sha256(data.encode('utf-8')).hexdigest() == shard['hash']
+                assert len(json.loads(data)) == shard['definitions']
+    return manifest
+
+
+def test_shared_file_gets_a_shard_per_header(headers, tmp_path):
+    headers(FILES)
+    assert len(write_shards('out', ['a.h', 'b.h'])) == 4
+    manifest = check_manifest('out')
+    assert sorted(manifest['headers']) == ['a.h', 'b.h']
+    # nothing changed, nothing is rewritten
+    assert write_shards('out', ['b.h', 'a.h']) == []
+
+
+def test_options_get_shards_of_their_own(headers):
+    headers(FILES)
+    write_shards('out', ['a.h'])
+    write_shards('out', ['a.h'], CLANG_ARGS + ['-DX=1'])
+    manifest = check_manifest('out')
+    assert len(manifest['headers']['a.h']) == 2
+    assert len(os.listdir('out')) == 5
+
+
+def test_removed_sources_drop_their_shards(headers):
+    headers(FILES)
+    write_shards('out', ['a.h'])
+    with open('a.h', 'w') as f:
+        f.write('int a_fn(int x);\n')
+    write_shards('out', ['a.h'])
+    manifest = check_manifest('out')
+    assert [list(e['shards']) for e in manifest['headers']['a.h'].values()] == [['a.h']]
+    assert len(os.listdir('out')) == 2
+
+
+def test_shards_hold_each_headers_definitions(headers, capsys):
+    headers(FILES)
+    argv = ['--shards', 'out', 'a.h', 'b.h', '-e', 'libclang', '--xargs', *(' ' + arg for arg in CLANG_ARGS)]
+    assert cj.main(argv) == 0
+    assert len(capsys.readouterr().out.splitlines()) == 4
+    manifest = check_manifest('out')
+    for header, variants in manifest['headers'].items():
+        [entry] = variants.values()
+        definitions = []
+        for shard in entry['shards'].values():
+            with open(os.path.join('out', shard['file'])) as f:
+                definitions.extend(json.load(f))
+        expected = cj.defs(header, clang_args=CLANG_ARGS, engine='libclang')
+        assert sorted(map(cj.fingerprint, definitions)) == sorted(map(cj.fingerprint, expected))
+    assert cj.main(argv) == 0
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,41 @@
+import pytest
+
+import cj
+from conftest import CLANG_ARGS, edit, constants
+
+FILES = {
+    'base.h': 'int base_fn(void);\n#define BASE 1\nenum { E1 = 3 };\ntypedef int word_t;\n',
+    'mid.h': '#include "base.h"\nint mid_fn(void);\n#define MID (BASE * 2)\n',
+    'main.h': '#include "mid.h"\nint main_fn(void);\n#define DERIVED (MID + 1)\n'
+              '#define FROM_ENUM (E1 + 1)\n#define CAST ((word_t)5)\n#define OTHER 7\n',
+}
+
+
+def fresh(evaluate_macros):
+    return cj.defs('main.h', clang_args=CLANG_ARGS, engine='libclang', evaluate_macros=evaluate_macros)
+
+
+@pytest.mark.parametrize('evaluate_macros', [True, False], ids=['evaluate', 'probe-all'])
+def test_update_redoes_dependent_constants(headers, evaluate_macros):
+    headers(FILES)
+    visitor = cj.Visitor('main.h', clang_args=CLANG_ARGS, engine='libclang', watch=True,
+                         evaluate_macros=evaluate_macros)
+    assert visitor.all_definitions() == fresh(evaluate_macros)
+    for old, new in [('#define BASE 1\n', '#define BASE 1.5\n'),
+                     ('E1 = 3', 'E1 = 3000000000'),
+                     ('typedef int word_t', 'typedef long word_t'),
+                     ('#define BASE 1.5\n', '')]:
+        edit('base.h', old, new)
+        assert visitor.update()
+        assert visitor.all_definitions() == fresh(evaluate_macros)
+    assert constants(visitor.all_definitions()) == {
+        'E1': None, 'FROM_ENUM': 'const unsigned int', 'CAST': 'const long', 'OTHER': 'const int'}
+
+
+def test_update_keeps_fresh_run_order(headers):
+    headers(FILES)
+    visitor = cj.Visitor('main.h', clang_args=CLANG_ARGS, engine='libclang', watch=True)
+    edit('base.h', 'int base_fn(void);\n', 'struct early { char c; };\nint base_fn(struct early *e);\n')
+    edit('mid.h', 'int mid_fn(void);\n', 'typedef struct m { long q; } m_t;\nint mid_fn(m_t m);\n')
+    assert visitor.update()
+    assert visitor.all_definitions() == fresh(True)
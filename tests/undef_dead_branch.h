@@ -0,0 +1,23 @@
+/*
+ * An `#undef` in a branch that isn't compiled must not drop the macro.
+ * Expected constants: KEPT, REDEFINED. Not UNDEFINED.
+ */
+#ifndef UNDEF_DEAD_BRANCH_H
+#define UNDEF_DEAD_BRANCH_H
+
+#define KEPT 1
+#define UNDEFINED 2
+#define REDEFINED 3
+
+#ifdef NOT_DEFINED_ANYWHERE
+#undef KEPT
+#endif
+
+#undef UNDEFINED
+
+#undef REDEFINED
+#define REDEFINED 4
+
+int undef_dead_branch(void);
+
+#endif